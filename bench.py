@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+## Throughput benchmarks for marc.py.
+##
+##   python bench.py generate corpus.mrc --records 1000000
+##   python bench.py run corpus.mrc --save baseline.json
+##   python bench.py run corpus.mrc --baseline baseline.json
+##
+## generate writes a synthetic MARC21 file by drawing records at random
+## from harvard.sample.json, so the field mix, value lengths and record
+## types follow the sample; each record gets a fresh 001 id. run times
+## every stage of a conversion separately, plus the whole process_file
+## pipeline, and reports records/sec and MB/sec (MB of input for the read
+## and parse stages, MB of output for the output modes).
+import sys
+import os
+import json
+import random
+import shutil
+import tempfile
+import argparse
+import time
+import gc
+from marc21 import *
+import marc
+
+## Corpus generation.
+def sample_records(path='harvard.sample.json'):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def to_marc(d):
+    """The MARC21 record a converted sample record came from, near enough:
+    control fields and the subfields in fieldmap. Indicators are lost."""
+    codes = dict((v, k) for k, v in marc.fieldmap.iteritems())
+    m = MARC21Record()
+    m.record_status = 'n'
+    m.type_of_record = 'a'
+    m.implementation_defined1 = 'm '
+    tags = {}
+    for k, v in d.iteritems():
+        code = codes.get(k)
+        if code is None:
+            continue
+        if len(code) == 3:
+            m[code] = v.encode('utf-8')
+        else:
+            tags.setdefault(code[:3], {})[code[3]] = [x.encode('utf-8') for x in v]
+    for tag, subfields in tags.iteritems():
+        field = MARC21DataField()
+        field.indicator1 = ' '
+        field.indicator2 = ' '
+        for code, values in subfields.iteritems():
+            field[code] = values if len(values) > 1 else values[0]
+        m[tag] = field
+    return m
+
+ID = '\x01' * 9
+
+def templates(records):
+    """Each sample record serialized with a placeholder 001, and the offset
+    of the placeholder, so a new record is just a splice."""
+    ret = []
+    for d in records:
+        d = dict(d, id=ID.decode('ascii'))
+        data = str(to_marc(d))
+        ret.append((data, data.index(ID)))
+    return ret
+
+def generate(path, count, seed=0, sample='harvard.sample.json'):
+    rand = random.Random(seed)
+    pool = templates(sample_records(sample))
+    size = 0
+    with open(path, 'wb') as out:
+        chunk = []
+        for n in xrange(1, count + 1):
+            data, i = rand.choice(pool)
+            chunk.append(data[:i] + '%09d' % n + data[i + 9:])
+            if len(chunk) == 10000:
+                size += write_chunk(out, chunk)
+        size += write_chunk(out, chunk)
+    return size
+
+def write_chunk(out, chunk):
+    data = ''.join(chunk)
+    out.write(data)
+    del chunk[:]
+    return len(data)
+
+
+## Timing.
+class Timer:
+    """Accumulated time, records and bytes for each stage, in run order."""
+    def __init__(self):
+        self.order = []
+        self.stats = {}
+
+    def add(self, stage, seconds, records, size):
+        if stage not in self.stats:
+            self.order.append(stage)
+            self.stats[stage] = {'seconds': 0.0, 'records': 0, 'bytes': 0}
+        s = self.stats[stage]
+        s['seconds'] += seconds
+        s['records'] += records
+        s['bytes'] += size
+
+    def rates(self, stage):
+        s = self.stats[stage]
+        seconds = s['seconds'] or 1e-9
+        return s['records'] / seconds, s['bytes'] / seconds / (1 << 20)
+
+def time_stages(path, timer, tmpdir):
+    """One pass over path, timing each stage on every record: reading,
+    parsing, marc2dict, parse008 and guess_type, then every output mode.
+    The batch of records held for the batch encoders would make the cyclic
+    garbage collector charge its time to whichever stage happens to set it
+    off, so it runs between batches instead, untimed."""
+    gc.disable()
+    try:
+        stages(path, timer, tmpdir)
+    finally:
+        gc.enable()
+
+def stages(path, timer, tmpdir):
+    clock = time.time
+    data = MARC21File(path)
+    sinks = {}
+    args = argparse.Namespace(db=os.path.join(tmpdir, 'bench.db'),
+                              outdir=os.path.join(tmpdir, 'columns'))
+    for mode, make in marc.sinks.iteritems():
+        sinks[mode] = make(args)
+    batch = []
+    while True:
+        t = clock()
+        raw = data.nextRaw()
+        t1 = clock()
+        if raw is None:
+            break
+        size = len(raw[0]) if raw[1] == 0 else int(raw[0][raw[1]:raw[1] + 5])
+        timer.add('MARC21File.nextRaw', t1 - t, 1, size)
+
+        t = clock()
+        m = MARC21Record(raw[0], raw[1])
+        timer.add('MARC21Record.parse', clock() - t, 1, size)
+
+        t = clock()
+        d = marc.marc2dict(m)
+        timer.add('marc2dict', clock() - t, 1, size)
+        if not d.get('008'):
+            continue
+
+        t = clock()
+        record = marc.parse008(d['008'])
+        timer.add('parse008', clock() - t, 1, size)
+        for k, v in marc.fieldmap.iteritems():
+            if d.get(k):
+                record[v] = d[k]
+
+        t = clock()
+        record.update(marc.guess_type(record))
+        timer.add('guess_type', clock() - t, 1, size)
+        record['docid'] = record.get('id', '')[0:9]
+
+        for mode, encode in sorted(marc.encoders.iteritems()):
+            t = clock()
+            text = encode(record)
+            timer.add('mode ' + mode, clock() - t, 1, len(text))
+        for mode, sink in sorted(sinks.iteritems()):
+            t = clock()
+            sink.write(record)
+            timer.add('mode ' + mode, clock() - t, 1, 0)
+        batch.append(record)
+        if len(batch) == marc.ENCODE_BATCH:
+            time_batch(batch, timer)
+    time_batch(batch, timer)
+    for mode, sink in sorted(sinks.iteritems()):
+        t = clock()
+        sink.close()
+        timer.add('mode ' + mode, clock() - t, 0, 0)
+
+def time_batch(batch, timer):
+    for mode, encode in sorted(marc.batch_encoders.iteritems()):
+        t = time.time()
+        text = encode(batch)
+        timer.add('mode ' + mode, time.time() - t, len(batch), len(text))
+    del batch[:]
+    gc.collect()
+
+def time_pass(stage, timer, size, fn):
+    """Time fn(), which returns the number of records it went through."""
+    t = time.time()
+    n = fn()
+    timer.add(stage, time.time() - t, n, size)
+
+def read_all(path):
+    data = MARC21File(path)
+    n = 0
+    while data.next() is not None:
+        n += 1
+    return n
+
+def convert_all(path):
+    n = 0
+    for record in marc.process_file(path, lim=None):
+        n += 1
+    return n
+
+def run(path):
+    timer = Timer()
+    size = os.path.getsize(path)
+    tmpdir = tempfile.mkdtemp(prefix='marc-bench-')
+    stderr = sys.stderr
+    # process_file's progress lines would swamp the report.
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        time_pass('MARC21File.next', timer, size, lambda: read_all(path))
+        time_stages(path, timer, tmpdir)
+        time_pass('process_file', timer, size, lambda: convert_all(path))
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+        shutil.rmtree(tmpdir)
+    return timer
+
+
+## Reporting.
+def report(timer, baseline=None):
+    print '%-22s %12s %9s %9s%s' % ('stage', 'records/s', 'MB/s', 'seconds',
+                                    '  vs baseline' if baseline else '')
+    for stage in timer.order:
+        records, mb = timer.rates(stage)
+        mb = '%9.2f' % mb if timer.stats[stage]['bytes'] else '%9s' % '-'
+        line = '%-22s %12.0f %s %9.2f' % (stage, records, mb,
+                                          timer.stats[stage]['seconds'])
+        if baseline and stage in baseline.stats:
+            before = baseline.rates(stage)[0]
+            if before:
+                line += '  %+11.1f%%' % ((records / before - 1) * 100)
+        print line
+
+def load(path):
+    timer = Timer()
+    with open(path) as f:
+        saved = json.load(f)
+    for stage in saved['order']:
+        s = saved['stats'][stage]
+        timer.add(stage, s['seconds'], s['records'], s['bytes'])
+    return timer
+
+def save(timer, path, corpus):
+    with open(path, 'w') as f:
+        json.dump({'corpus': corpus, 'order': timer.order, 'stats': timer.stats},
+                  f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(usage="""
+    bench.py generate output.mrc [--records N] [--seed N]
+    bench.py run input.mrc [--save results.json] [--baseline results.json]
+""")
+    parser.add_argument('command', choices=['generate', 'run'])
+    parser.add_argument('path')
+    parser.add_argument('--records', type=int, default=100000,
+                        help='records to generate (default: 100000)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, so a corpus can be made again')
+    parser.add_argument('--save', help='save the results to this file')
+    parser.add_argument('--baseline',
+                        help='compare with results saved earlier by --save')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        size = generate(args.path, args.records, args.seed)
+        print >> sys.stderr, 'wrote %d records, %.1f MB' % (args.records, size / 1048576.0)
+    else:
+        timer = run(args.path)
+        report(timer, load(args.baseline) if args.baseline else None)
+        if args.save:
+            save(timer, args.save, {'path': args.path,
+                                    'bytes': os.path.getsize(args.path)})
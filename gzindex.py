@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+## Random access into gzip files, after examples/zran.c in the zlib
+## sources. build() decompresses a file once and, every SPACING bytes or so
+## of compressed input, notes a checkpoint where a deflate block starts:
+##
+##   out      the uncompressed offset of the block
+##   in       the compressed offset of its first whole byte
+##   bits     how many high bits of the byte before that start the block
+##   window   the 32KB of output before the block, which it may copy from
+##
+## A Resume decompressor then carries on from any checkpoint. Python's zlib
+## module can neither stop at block boundaries nor start from a saved
+## window, so this drives libz directly through ctypes.
+import ctypes
+import ctypes.util
+import zlib
+
+SPACING = 4 << 20
+WINDOW = 32768
+CHUNK = 1 << 16
+OUTPUT = 1 << 18
+
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+# inflateInit2() window bits: raw deflate data, or a gzip member.
+RAW = -15
+GZIP = 16 + 15
+# a gzip member ends with the crc32 and length of its data.
+TRAILER = 8
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+def load_libz():
+    path = ctypes.util.find_library('z')
+    if path is None:
+        return None
+    try:
+        libz = ctypes.CDLL(path)
+    except OSError:
+        return None
+    libz.zlibVersion.restype = ctypes.c_char_p
+    return libz
+
+libz = load_libz()
+
+class Inflater:
+    """A libz inflate stream. feed() gives it input, and each step() makes
+    one inflate() call into a fresh output buffer."""
+
+    def __init__(self, wbits):
+        self.stream = None
+        if libz is None:
+            raise IOError('random access into gzip files needs libz')
+        stream = ZStream()
+        self.check(libz.inflateInit2_(ctypes.byref(stream), wbits,
+                                      libz.zlibVersion(), ctypes.sizeof(ZStream)))
+        self.stream = stream
+        self.output = ctypes.create_string_buffer(OUTPUT)
+        self.input = ''
+
+    def __del__(self):
+        if self.stream is not None:
+            libz.inflateEnd(ctypes.byref(self.stream))
+
+    def check(self, ret):
+        if ret < 0 and ret != Z_BUF_ERROR:
+            msg = self.stream and self.stream.msg
+            raise zlib.error('Error %d while decompressing data%s' %
+                             (ret, ': ' + msg if msg else ''))
+        return ret
+
+    def feed(self, data):
+        # self.input keeps data alive while libz points into it.
+        self.input = data
+        self.stream.next_in = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        self.stream.avail_in = len(data)
+
+    def unused(self):
+        return self.input[len(self.input) - self.stream.avail_in:]
+
+    def step(self, flush):
+        """One inflate() call: its return code and the output."""
+        s = self.stream
+        s.next_out = ctypes.addressof(self.output)
+        s.avail_out = OUTPUT
+        ret = self.check(libz.inflate(ctypes.byref(s), flush))
+        return ret, ctypes.string_at(self.output, OUTPUT - s.avail_out)
+
+    def reset(self):
+        self.check(libz.inflateReset(ctypes.byref(self.stream)))
+
+    def prime(self, bits, byte, window):
+        """Start in the middle of a deflate stream, at a checkpoint."""
+        if bits:
+            self.check(libz.inflatePrime(ctypes.byref(self.stream), bits, byte >> (8 - bits)))
+        if window:
+            self.check(libz.inflateSetDictionary(ctypes.byref(self.stream), window, len(window)))
+
+
+def build(f, on_data, spacing=None):
+    """Decompress the gzip file f from the start, passing the output to
+    on_data() as it comes, and return the checkpoints, as tuples of
+    (out, in, bits, window). A file of several gzip members (from pigz, or
+    cat a.gz b.gz) is read through to the end."""
+    spacing = spacing or SPACING
+    inflater = Inflater(GZIP)
+    s = inflater.stream
+    checkpoints = []
+    window = ''
+    total_in = total_out = 0
+    last = -spacing
+    ended = False
+    while True:
+        data = f.read(CHUNK)
+        if not data:
+            break
+        inflater.feed(data)
+        while True:
+            before = s.avail_in
+            ret, out = inflater.step(Z_BLOCK)
+            total_in += before - s.avail_in
+            if out:
+                total_out += len(out)
+                on_data(out)
+                window = (window + out)[-WINDOW:] if len(out) < WINDOW else out[-WINDOW:]
+            ended = ret == Z_STREAM_END
+            if ended:
+                # another member may follow.
+                inflater.reset()
+            elif s.data_type & 128 and not s.data_type & 64 and total_in - last >= spacing:
+                # at a block boundary, and not past the last block.
+                checkpoints.append((total_out, total_in, s.data_type & 7, window))
+                last = total_in
+            if ret == Z_BUF_ERROR or not s.avail_in and s.avail_out:
+                break
+    if not ended:
+        raise IOError('gzip file ends in the middle of a member')
+    return checkpoints
+
+
+class Resume:
+    """A decompressor object like zlib.decompressobj(), for the data from a
+    checkpoint's in offset on; byte is the one before it, if bits. Like
+    zlib's, it stops at the end of the gzip member and leaves what follows
+    the trailer in unused_data, so BlockReader can carry on with the next
+    member. The trailer's crc32 isn't checked: it covers the whole member,
+    most of which this never sees."""
+
+    def __init__(self, bits, byte, window):
+        self.inflater = Inflater(RAW)
+        self.inflater.prime(bits, byte, window)
+        self.finished = False
+        self.trailer = TRAILER
+        self.unused_data = ''
+
+    def decompress(self, data):
+        chunks = []
+        if not self.finished:
+            inflater = self.inflater
+            s = inflater.stream
+            inflater.feed(data)
+            while True:
+                ret, out = inflater.step(Z_NO_FLUSH)
+                chunks.append(out)
+                if ret == Z_STREAM_END:
+                    self.finished = True
+                    data = inflater.unused()
+                    break
+                if ret == Z_BUF_ERROR or not s.avail_in and s.avail_out:
+                    return ''.join(chunks)
+        skip = min(self.trailer, len(data))
+        self.trailer -= skip
+        self.unused_data += data[skip:]
+        return ''.join(chunks)
@@ -7,6 +7,23 @@ import json
 import cgi
 from collections import defaultdict
 import glob
+import argparse
+import os
+import shutil
+import tempfile
+import multiprocessing
+import datetime
+import marshal
+import time
+import zlib
+import threading
+import Queue
+from marc_sqlite import SQLiteSink
+from marc_columns import ColumnSink
+from marc_delta import DeltaState
+from marc_dedup import Dedup
+from marc_stats import Meter
+from marc_gzip import GzipBlockWriter, INDEX as BLOCK_INDEX
 
 def listify(x):
     if type(x) == type([]):
@@ -103,72 +120,110 @@ def parse008_music(code):
 #   excerpt
 #   pamphlet
 #   illustrations
-def guess_type(r):
-    global video_techniques
-    ret = {'type': 'unknown'}
-    r008 = r.get('r008', '')
-    if len(r008) < 36:
-        return ret
+#
+# The heuristics are a table of rules in priority order: every rule that
+# fires sets the type in turn, so the last one to fire wins. A rule's
+# test is either a regex searched for in one of the physical_desc fields,
+# or a function of (record, r008). Its action, if any, adds metadata
+# from the match groups (or the 008 codes).
+
+def set_video_technique(ret, groups, r008):
+    if video_techniques.get(r008[35]):
+        ret['video_technique'] = video_techniques.get(r008[35])
 
-    physical_desc = str(r.get('physical_desc', ''))
-    physical_desc_2 = str(r.get('physical_desc_2', ''))
+def set_page_count(ret, groups, r008):
+    ret['page_count'] = pagenum(groups[0])
 
+def set_excerpt_pages(ret, groups, r008):
+    ret['page_count'] = safeint(groups[1]) - pagenum(groups[0])
+
+def set_music(ret, groups, r008):
+    ret.update(parse008_music(r008))
+
+type_rules = [
     # definitive and mostly complete.
     # todo: "online reasources"
-    if r008[29:34] == '    v' or re.search(r'video', physical_desc):
-        ret['type'] = 'video'
-        if video_techniques.get(r['r008'][35]):
-            ret['video_technique'] = video_techniques.get(r008[35])
+    ('video', None, lambda r, r008: r008[29:34] == '    v', set_video_technique),
+    ('video', 'physical_desc', r'video', set_video_technique),
 
     # definitive, but not complete.
     # todo: topo info
-    if r008[25:29] == 'a   s':
-        ret['type'] = 'map'
+    ('map', None, lambda r, r008: r008[25:29] == 'a   s', None),
 
-    if physical_desc.find('sound disc') > -1:
-        ret['type'] = 'audio'
+    ('audio', 'physical_desc', r'sound disc', None),
 
-    if r.get('issn'):
-        ret['type'] = 'periodical'
+    ('periodical', None, lambda r, r008: r.get('issn'), None),
 
     ## Detect books by page count notation in the desecription.
     ## yes, some page counts are in Roman numerals (!!)
-    m = re.search(r'\[?(\d+|[cxvi]+)\]?\s*p\b', physical_desc)
-    if m:
-        ret['type'] = 'book'
-        ret['page_count'] = pagenum(m.group(1))
+    ('book', 'physical_desc', r'\[?(\d+|[cxvi]+)\]?\s*p\b', set_page_count),
 
     # excepts have this format: "p. [241]-269"
-    m = re.search(r'p?p\.?\s*\[?(\d+)\]?-\[?(\d+)\]?', physical_desc)
-    if m:
-        ret['type'] = 'excerpt'
-        ret['page_count'] = safeint(m.group(2)) - pagenum(m.group(1))
+    ('excerpt', 'physical_desc', r'p?p\.?\s*\[?(\d+)\]?-\[?(\d+)\]?', set_excerpt_pages),
 
     # "2 v." means two volumes
-    m = re.search(r'(\d+)\s*(?:v\.?|parts|volume|vol)\b', physical_desc)
-    if m:
-        ret['type'] = 'book'
+    ('book', 'physical_desc', r'(\d+)\s*(?:v\.?|parts|volume|vol)\b', None),
 
     # various ways to describe pages/sheets/leaves
-    m = re.search(r'\[?\d+\]? (?:double|sheet|folded sheet|fold|leaf|leaves|plate|pamphlet|\xe2\x84\x93|\u2113)|Broadside|broadside|\bv\.', physical_desc)
-    if m:
-        ret['type'] = 'pamphlet'
+    ('pamphlet', 'physical_desc', r'\[?\d+\]? (?:double|sheet|folded sheet|fold|leaf|leaves|plate|pamphlet|\xe2\x84\x93|\u2113)|Broadside|broadside|\bv\.', None),
 
     # ...except illustrations.
-    m = re.search(r'ill\.|illus|sketch|plan|poster|diagr', physical_desc_2)
-    if m:
-        ret['type'] = 'book'
+    ('book', 'physical_desc_2', r'ill\.|illus|sketch|plan|poster|diagr', None),
 
-    m = re.search(r'(\d+)(?: map|maps)\b|maps', physical_desc)
-    if m:
-        ret['type'] = 'map'
+    ('map', 'physical_desc', r'(\d+)(?: map|maps)\b|maps', None),
 
     # very good chance it's music.
-    if r.get('lang') == 'No linguistic content' or re.search(r'(?:sound|audio) disc', physical_desc):
-        ret['type'] = 'music'
-        ret.update(parse008_music(r008))
-        #print >> sys.stderr, ret
+    ('music', None, lambda r, r008: r.get('lang') == 'No linguistic content', set_music),
+    ('music', 'physical_desc', r'(?:sound|audio) disc', set_music),
+]
+
+def compile_rules(rules):
+    """Combine the regex rules on each field into a single pattern, so one
+    match() call per field reports every rule that fires. Each rule becomes
+    an optional lookahead, (?:(?=.*?(rule)))?, which finds the same
+    leftmost match (and groups) that re.search(rule) would.
+
+    Returns [(field, pattern, [(rule index, group, ngroups)])], where group
+    indexes the rule's own group in match.groups() and its ngroups regex
+    groups follow it, and [(rule index, test)] for the predicate rules."""
+    patterns = []
+    predicates = []
+    for field in sorted(set(rule[1] for rule in rules if rule[1])):
+        parts = []
+        groups = []
+        g = 0
+        for i, (kind, f, test, action) in enumerate(rules):
+            if f == field:
+                parts.append('(?:(?=.*?(%s)))?' % test)
+                groups.append((i, g, re.compile(test).groups))
+                g += 1 + groups[-1][2]
+        patterns.append((field, re.compile(''.join(parts), re.S), groups))
+    for i, (kind, field, test, action) in enumerate(rules):
+        if not field:
+            predicates.append((i, test))
+    return patterns, predicates
+
+type_patterns, type_predicates = compile_rules(type_rules)
 
+def guess_type(r):
+    ret = {'type': 'unknown'}
+    r008 = r.get('r008', '')
+    if len(r008) < 36:
+        return ret
+
+    fired = [(i, ()) for i, test in type_predicates if test(r, r008)]
+    for field, pattern, rules in type_patterns:
+        m = pattern.match(str(r.get(field, ''))).groups()
+        fired.extend([(i, m[g + 1:g + 1 + n]) for i, g, n in rules if m[g] is not None])
+
+    # every rule that fired sets the type in priority order, so the
+    # highest priority one wins.
+    fired.sort()
+    for i, groups in fired:
+        kind, field, test, action = type_rules[i]
+        ret['type'] = kind
+        if action:
+            action(ret, groups, r008)
 
     if ret['type'] == 'unknown':
         pass # print >> sys.stderr, r
@@ -283,74 +338,613 @@ fields = sorted(fieldmap.values() + [
 ])
 
 
-def process_file(f, lim=2000000):
-    print >> sys.stderr, f
-    data = MARC21File(f)
-    for i in range(lim):
-        if i and i % 1000 == 0:
+# columns computed from other columns, and what they are computed from.
+# parse008 always runs, since the 008 field is required.
+derived = {
+    'pub_date': ['r008'],
+    'country': ['r008'],
+    'lang': ['r008'],
+    'docid': ['id'],
+}
+# ...and the ones set by guess_type.
+classified = ('type', 'video_technique', 'page_count', 'music_form', 'music_score')
+for k in classified:
+    derived[k] = ['r008', 'physical_desc', 'physical_desc_2', 'issn']
+
+def compile_plan(columns=None):
+    """Compile fieldmap into an extraction plan for the given output columns
+    (default: all of them). Returns a sorted list of (tag, [subfields])
+    pairs naming only the MARC data those columns need, and whether
+    guess_type has to run."""
+    if columns is None:
+        columns = fields
+    needed = set(columns)
+    for c in columns:
+        needed.update(derived.get(c, []))
+    tags = defaultdict(list)
+    for k, v in fieldmap.iteritems():
+        if v in needed:
+            tags[k[:3]].append(k[3:])
+    tags['008'] = ['']
+    plan = [(tag, sorted(subfields)) for tag, subfields in sorted(tags.items())]
+    classify = bool(needed.intersection(classified))
+    return plan, classify
+
+## Interning. A few columns take only a handful of values across millions
+## of records: the code table outputs of parse008 and guess_type, and code
+## fields such as the 040 'MH' cataloging source. When records are held in
+## memory, sharing one copy of each saves RSS. Streamed records are freed
+## as they go, so there interning only costs the table.
+class Interner:
+    """Returns one shared copy of each value passed in, remembering at
+    most limit distinct values, and counts the bytes saved."""
+    def __init__(self, limit=10000):
+        self.values = {}
+        self.limit = limit
+        self.saved = 0
+
+    def net(self):
+        """The bytes saved, less those of the table and the values it keeps."""
+        return self.saved - sys.getsizeof(self.values) - \
+            sum([sys.getsizeof(v) for v in self.values])
+
+    def __call__(self, s):
+        v = self.values.get(s)
+        if v is None:
+            if len(self.values) < self.limit:
+                self.values[s] = s
+            return s
+        if v is not s:
+            self.saved += sys.getsizeof(s)
+        return v
+
+interner = Interner()
+
+# code table outputs of parse008 and guess_type...
+interned_outputs = ['country', 'lang', 'type', 'video_technique',
+                    'music_form', 'music_score']
+# ...and the code fields.
+interned_columns = ['governing_source', 'catalog_source', 'modifying_agency',
+                    'auth_code', 'geo_area_code']
+interned_keys = set(k for k, v in fieldmap.iteritems() if v in interned_columns)
+
+def extract(record, plan, intern=None):
+    """Like marc2dict, but decodes and strips only the (tag, subfield)
+    pairs in plan. Works best on a lazy MARC21Record. If given an Interner,
+    values of the interned_columns go through it."""
+    ret = {}
+    for field, subfields in plan:
+        if field not in record:
+            continue
+        for line in listify(record[field]):
+            if isControlField(field):
+                ret[field] = stripper(line)
+            else:
+                for subfield in subfields:
+                    if subfield in line:
+                        values = ret.setdefault(field+subfield, [])
+                        if intern and field+subfield in interned_keys:
+                            for line2 in listify(line[subfield]):
+                                values.append(intern(stripper(line2)))
+                        else:
+                            for line2 in listify(line[subfield]):
+                                values.append(stripper(line2))
+    return ret
+
+
+## --stats: stage timings and progress. Pool workers post theirs to the
+## parent (see start_worker), which reports for the whole run.
+meter = Meter()
+
+def timed_records(data, start, count, batch, where, stats):
+    """data.records(start, count, batch, where), timing reading and parsing
+    apart. nextBatch() does both at once, so with batch it all counts as
+    read, as does filtering with where."""
+    clock = time.time
+    if batch:
+        records = data.records(start, count, batch, where)
+        while True:
+            t = clock()
+            m = next(records, None)
+            stats.add('read', clock() - t, 1 if m is not None else 0)
+            if m is None:
+                return
+            yield m
+    data.seekRecord(start)
+    i = 0
+    while count is None or i < count:
+        t = clock()
+        raw = data.nextRaw()
+        if raw is None:
+            return
+        i += 1
+        if where is not None and not where(raw[0], raw[1]):
+            stats.add('read', clock() - t)
+            continue
+        t1 = clock()
+        m = MARC21Record(raw[0], raw[1], lazy=True)
+        stats.add('read', t1 - t)
+        stats.add('parse', clock() - t1)
+        yield m
+
+## --pipeline: reading, converting and writing overlap on three threads.
+## A reader thread steps through the file and hands raw records over in
+## blocks, the calling thread parses and converts them, and a writer
+## thread drains the encoded output. The queues between them are bounded,
+## so a fast stage waits for a slow one instead of filling memory, and
+## with one thread per stage the order is that of a serial run.
+PIPELINE_BLOCK = 500    # raw records per block handed to the parser
+PIPELINE_DEPTH = 8      # blocks queued between two stages
+WRITE_BLOCK = 1 << 16   # bytes of output per block handed to the writer
+
+class Stopped(Exception):
+    pass
+
+def read_ahead(data, start, count, batch, where, stats=None):
+    """data.records(start, count, batch, where), with the raw records read
+    on a thread of their own, batch (or PIPELINE_BLOCK) at a time."""
+    blocks = Queue.Queue(PIPELINE_DEPTH)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+        raise Stopped()
+
+    def reader():
+        try:
+            data.seekRecord(start)
+            end = None if count is None else data.current + count
+            block = []
+            while end is None or data.current < end:
+                raw = data.nextRaw()
+                if raw is None:
+                    break
+                if where is None or where(raw[0], raw[1]):
+                    block.append(raw)
+                    if len(block) == (batch or PIPELINE_BLOCK):
+                        put(block)
+                        block = []
+            put(block)
+            put(None)
+        except Stopped:
+            pass
+        except Exception:
+            try:
+                put(sys.exc_info())
+            except Stopped:
+                pass
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    clock = time.time
+    try:
+        while True:
+            t = clock()
+            block = blocks.get()
+            if block is None:
+                return
+            if isinstance(block, tuple):
+                raise block[0], block[1], block[2]
+            t1 = clock()
+            if batch:
+                records = data.parseRaws(block)
+            else:
+                records = [MARC21Record(raw[0], raw[1], lazy=True) for raw in block]
+            if stats:
+                stats.add('read', t1 - t, len(block))
+                stats.add('parse', clock() - t1, len(block))
+            for m in records:
+                yield m
+    finally:
+        stop.set()
+        thread.join()
+
+class Consumer:
+    """Passes each item put() to handle() on a thread of its own, behind a
+    queue of PIPELINE_DEPTH items; setup() runs there first, and finish()
+    once close() has put the last item. An error on the thread is raised by
+    the next put() or close()."""
+
+    def __init__(self):
+        self.error = None
+        self.items = Queue.Queue(PIPELINE_DEPTH)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def setup(self):
+        pass
+
+    def handle(self, item):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def run(self):
+        done = False
+        try:
+            self.setup()
+            while True:
+                item = self.items.get()
+                if item is None:
+                    done = True
+                    break
+                self.handle(item)
+            self.finish()
+        except Exception:
+            self.error = sys.exc_info()
+            # keep draining, so put() never blocks on a full queue.
+            while not done:
+                done = self.items.get() is None
+
+    def check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def put(self, item):
+        self.check()
+        self.items.put(item)
+
+    def close(self):
+        self.items.put(None)
+        self.thread.join()
+        self.check()
+
+class WriteBehind(Consumer):
+    """A file-like object whose write() queues its data for a thread that
+    writes it to out, so converting never waits on a slow disk or pipe.
+    An error writing is raised by the next write() or close()."""
+
+    def __init__(self, out):
+        self.out = out
+        self.buffer = []
+        self.size = 0
+        Consumer.__init__(self)
+
+    def handle(self, block):
+        self.out.write(block)
+
+    def write(self, data):
+        self.check()
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= WRITE_BLOCK:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.put(''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def close(self):
+        self.flush()
+        Consumer.close(self)
+        self.out.flush()
+
+def process_file(f, lim=2000000, mapped=False, start=0, indexed=False, span=None,
+                 columns=None, batch=0, intern=False, stats=False, where=None,
+                 pipeline=False):
+    print >> sys.stderr, f, span or ''
+    plan, classify = compile_plan(columns)
+    where = compileFilter(where) if where else None
+    intern = interner if intern else None
+    stats = meter if stats else None
+    keep = set(columns) if columns is not None else None
+    # without an index, --start skips over records by their leader lengths.
+    data = MARC21File(f, mapped, indexed, span, lazy=True)
+    if stats:
+        stats.open(data)
+    if pipeline:
+        records = read_ahead(data, start, lim, batch, where, stats)
+    elif stats:
+        records = timed_records(data, start, lim, batch, where, stats)
+    else:
+        records = data.records(start, lim, batch, where)
+    clock = time.time
+    for i, m in enumerate(records):
+        if i and i % 1000 == 0 and not stats:
             print >> sys.stderr, i, 'records'
-        m = data.next()
-        if not m: return
-        marc = marc2dict(m)
+        t = clock()
+        marc = extract(m, plan, intern)
+        t1 = clock()
 
         if not marc.get('008'):
             print >> sys.stderr, '008 record not found', marc
             continue
 
         record = parse008(marc['008'])
+        t2 = clock()
 
         for k,v in fieldmap.iteritems():
             if marc.get(k):
                 record[v] = marc[k]
+        t3 = clock()
+
+        if classify:
+            record.update(guess_type(record))
 
-        record.update(guess_type(record))
+        if stats:
+            stats.add('extract', t1 - t + t3 - t2)
+            stats.add('parse008', t2 - t1)
+            stats.add('classify', clock() - t3)
+            stats.record()
+
+        if intern:
+            for k in interned_outputs:
+                if k in record:
+                    record[k] = intern(record[k])
 
         # many systems (eg Sphinx) require a numeric uniq id.
         # the first nine characters of this field will serve.
         record['docid'] = record.get('id', '')[0:9]
 
+        if keep is not None:
+            for k in record.keys():
+                if k not in keep:
+                    del record[k]
+
         yield record
 
+    if stats:
+        stats.close()
+    if intern:
+        print >> sys.stderr, 'interning saved', intern.net(), 'bytes'
 
-if __name__ == '__main__':
 
-    if len(sys.argv) < 2 or sys.argv[1] not in ('sql', 'json', 'xmlpipe2', 'html'):
-        print >> sys.stderr, """
-usage:
-    marc.py sql|json|xmlpipe2|html [input]
-"""
-        sys.exit(1)
+## Output formats. Each encoder turns one record into a chunk of text,
+## so the same code serves the serial loop and the worker processes.
+##
+## With --state, once there is a state file, the output is a delta (see
+## delta_records) to apply to the load of the run that wrote it: the SQL
+## formats keep the tables, and remove the rows of changed and deleted
+## records by docid before adding the new versions. The first run is a
+## whole load, like one without --state.
+delta = False
 
-    if len(sys.argv) >= 3:
-        files = [sys.argv[2]]
-    else:
-        files = glob.glob('data/hlom/*.mrc')
+# the changes that replace or remove a row loaded before.
+replaced = ['changed', 'deleted']
 
-    if sys.argv[1] == 'sql':
-        print 'drop table harvard;'
-        print 'create table harvard ('
-        print ','.join(['%s varchar(255)' % f for f in fields])
-        print ');'
-        for f in files:
-            for record in process_file(f):
-                sql = "insert into harvard values('"
-                sql += "','".join([str(record.get(k, '')).replace("'", r"''") for k in fields])
-                sql += "');"
-                print sql
+def keyed(mode, state):
+    """Whether the output of mode needs every record's docid, whatever
+    --columns says: the pgcopy child tables are keyed by it, Sphinx
+    documents are numbered by it, and with state, a delta replaces the rows
+    of the other SQL formats by it."""
+    return mode in ('pgcopy', 'xmlpipe2') or state and mode in ('sql', 'sqlite')
 
-    elif sys.argv[1] == 'json':
-        for f in files:
-            for record in process_file(f):
-                print json.dumps(record) + '\n'
+def table_fields():
+    """The columns of the sql and sqlite tables: fields, and under --state
+    the docid that rows are replaced by (see keyed)."""
+    if 'change' in fields and 'docid' not in fields:
+        return ['docid'] + fields
+    return fields
 
-    elif sys.argv[1] == 'tsv':
-        for f in files:
-            for record in process_file(f):
-                print "\t".join([str(record.get(k, '')) for k in fields])
+def to_sql(record):
+    sql = ''
+    if record.get('change') in replaced:
+        sql += "delete from harvard where docid='%s';\n" % \
+            str(record.get('docid', '')).replace("'", r"''")
+        if record['change'] == 'deleted':
+            return sql
+    sql += "insert into harvard values('"
+    sql += "','".join([str(record.get(k, '')).replace("'", r"''") for k in table_fields()])
+    sql += "');"
+    return sql + '\n'
+
+def to_json(record):
+    return json.dumps(record) + '\n\n'
+
+def to_tsv(record):
+    return "\t".join([str(record.get(k, '')) for k in fields]) + '\n'
+
+# Sphinx indexer input format. A deleted record (see delta_records) goes
+# into a kill-list instead, which hides its docid in the indexes built
+# before this one; Sphinx takes any number of them.
+def to_xmlpipe2(record):
+    if record.get('change') == 'deleted':
+        return '<sphinx:killlist><id>%s</id></sphinx:killlist>\n\n' % \
+            cgi.escape(str(record.get('docid', '')))
+    r = {
+        'docid': '',
+        'title': '',
+        'pub_date': '',
+        'subtitle': '',
+        'alt_title': '',
+        'title_abbr': '',
+        'type': '',
+        'author': '',
+        'author2': '',
+        'publisher': '',
+        'corporate_name': '',
+        'country': '',
+        'lang': '',
+        'isbn': '',
+        'invalid_isbn': '',
+        'physical_desc': '',
+        'physical_desc_2': '',
+        'topical_terms': '',
+        'topical_terms_2': '',
+        'genre': '',
+        'general_note': '',
+        'series': '',
+        'series2': '',
+        'subject_personal_name': '',
+        'change': '',
+    }
+    r.update(record)
+
+    for k, v in r.iteritems():
+        if type(v) == type([]):
+            r[k] = ' '.join(v)
+        r[k] = cgi.escape(str(r[k]))
+
+    return """
+<sphinx:document id="{docid}">
+<title>{title} {subtitle} {alt_title} {title_abbr}</title>
+<type>{type}</type>
+<date>{pub_date}</date>
+<author>{author} {author2}</author>
+<publisher>{publisher} {corporate_name}</publisher>
+<country>{country}</country>
+<lang>{lang}</lang>
+<isbn>{isbn} {invalid_isbn}</isbn>
+<misc>{physical_desc} {physical_desc_2} {topical_terms} {topical_terms_2} {genre} {general_note} {series} {series2} {subject_personal_name}</misc>
+{change_element}</sphinx:document>
+
+""".format(change_element='<change>%s</change>\n' % r['change'] if 'change' in fields else '',
+           **r)
+
+encoders = {
+    'sql': to_sql,
+    'json': to_json,
+    'tsv': to_tsv,
+    'xmlpipe2': to_xmlpipe2,
+}
+
+## PostgreSQL COPY format. Multi-valued fields go to child tables
+## harvard_<field>(docid, seq, value), the rest to typed columns of
+## harvard. Records are written in batches of ENCODE_BATCH, each batch as
+## one COPY block per table, so the output streams and still loads fast.
+multi_valued = [
+    'isbn', 'invalid_isbn', 'issn', 'alt_title', 'author2', 'author2_dates',
+    'corporate_name', 'system_control_number', 'topical_terms',
+    'topical_terms_2', 'geo_name', 'geo_subdivision', 'geo_general_subdivision',
+    'form_subdivision', 'genre', 'general_note', 'bibliography', 'series',
+    'series2', 'subject_personal_name', 'url_host', 'url_path',
+    'alt_glyph_a', 'alt_glyph_b', 'alt_glyph_c', 'alt_glyph_d',
+    'alt_glyph_link_ref',
+]
+
+def pg_text(v):
+    if isinstance(v, list):
+        v = '; '.join(v)
+    if v is None or v == '':
+        return r'\N'
+    return (str(v).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+def pg_int(v):
+    if isinstance(v, (int, long)) or (isinstance(v, str) and v.isdigit()):
+        return str(v)
+    return r'\N'
+
+def pg_date(v):
+    # 008 dates are often partly unknown (eg. '19||-||-||'); those are null.
+    m = re.match(r'(\d{4})-?(\d\d)-?(\d\d)$', listify(v)[0] if v else '')
+    try:
+        return datetime.date(*map(int, m.groups())).isoformat()
+    except (AttributeError, ValueError):
+        return r'\N'
+
+def pg_timestamp(v):
+    # field 005 is yyyymmddhhmmss.f
+    m = re.match(r'(\d{4})(\d\d)(\d\d)(\d\d)(\d\d)(\d\d)', v or '')
+    try:
+        return datetime.datetime(*map(int, m.groups())).isoformat(' ')
+    except (AttributeError, ValueError):
+        return r'\N'
+
+pg_types = {
+    'docid': ('bigint', pg_int),
+    'page_count': ('integer', pg_int),
+    'pub_date': ('date', pg_date),
+    'catalog_date': ('date', pg_date),
+    'update_date': ('timestamp', pg_timestamp),
+}
+
+def pg_columns():
+    return ['docid'] + [f for f in fields if f != 'docid' and f not in multi_valued]
+
+def pg_children():
+    return [f for f in fields if f in multi_valued]
+
+def pgcopy_header(transaction=True):
+    # the load runs in one transaction unless the header is a file of its
+    # own (see ShardWriter), which can't leave one open for the footer.
+    sql = 'begin;\n' if transaction else ''
+    create = 'create table if not exists' if delta else 'create table'
+    if not delta:
+        for f in pg_children() + ['']:
+            sql += 'drop table if exists harvard%s;\n' % ('_' + f if f else '')
+    sql += create + ' harvard (\n'
+    sql += ',\n'.join(['  %s %s' % (f, pg_types.get(f, ('text',))[0])
+                       for f in pg_columns()])
+    sql += '\n);\n'
+    for f in pg_children():
+        sql += '%s harvard_%s (docid bigint, seq smallint, value text);\n' % (create, f)
+    if delta:
+        # the rows replaced are found by docid (see to_pgcopy).
+        sql += 'create index if not exists harvard_docid on harvard (docid);\n'
+    return sql
+
+def pgcopy_footer(transaction=True):
+    # indexes are cheaper to build once the data is in.
+    sql = ''
+    create = 'create index if not exists' if delta else 'create index'
+    for f in pg_children():
+        sql += '%s harvard_%s_docid on harvard_%s (docid);\n' % (create, f, f)
+    return sql + ('commit;\n' if transaction else '')
+
+def to_pgcopy(records):
+    columns = pg_columns()
+    convert = [pg_types.get(f, (None, pg_text))[1] for f in columns]
+    rows = []
+    gone = [pg_int(r.get('docid')) for r in records if r.get('change') in replaced]
+    gone = [docid for docid in gone if docid != r'\N']
+    if gone:
+        for table in [''] + pg_children():
+            rows.append('delete from harvard%s where docid in (%s);\n' % (
+                '_' + table if table else '', ','.join(gone)))
+    records = [r for r in records if r.get('change') != 'deleted']
+    rows.append('copy harvard (%s) from stdin;\n' % ','.join(columns))
+    for record in records:
+        rows.append('\t'.join([c(record.get(f)) for f, c in zip(columns, convert)]) + '\n')
+    rows.append('\\.\n')
+    for f in pg_children():
+        rows.append('copy harvard_%s (docid, seq, value) from stdin;\n' % f)
+        for record in records:
+            docid = pg_int(record.get('docid'))
+            for seq, value in enumerate(listify(record.get(f) or [])):
+                rows.append('%s\t%d\t%s\n' % (docid, seq, pg_text(value)))
+        rows.append('\\.\n')
+    return ''.join(rows)
 
-    # Sphinx indexer input format
-    elif sys.argv[1] == 'xmlpipe2':
-        print """<?xml version="1.0" encoding="utf-8"?>
+## NDJSON: one compact JSON object per line. The encoder is built once,
+## with the checks json.dumps() does for arbitrary input turned off, so
+## each record goes through the C encoder directly (records hold only
+## strings, lists of strings and ints).
+ndjson_encoder = json.JSONEncoder(separators=(',', ':'), check_circular=False)
+
+def to_ndjson(records):
+    encode = ndjson_encoder.encode
+    return '\n'.join([encode(record) for record in records]) + '\n'
+
+# formats that encode a whole batch of records at once, and the number of
+# records in a batch. Each batch goes out in one write.
+batch_encoders = {
+    'pgcopy': to_pgcopy,
+    'ndjson': to_ndjson,
+}
+
+ENCODE_BATCH = 10000
+
+def sql_header():
+    if delta:
+        return ('create table if not exists harvard (\n' +
+                ','.join(['%s varchar(255)' % f for f in table_fields()]) + '\n);\n')
+    return ('drop table harvard;\ncreate table harvard (\n' +
+            ','.join(['%s varchar(255)' % f for f in table_fields()]) + '\n);\n')
+
+def xmlpipe2_header():
+    change = '<sphinx:attr name="change" type="string"/>\n' if 'change' in fields else ''
+    return """<?xml version="1.0" encoding="utf-8"?>
 <sphinx:docset>
 <sphinx:schema>
 <sphinx:field name="title"/>
@@ -362,55 +956,662 @@ usage:
 <sphinx:field name="lang"/>
 <sphinx:field name="isbn"/>
 <sphinx:field name="misc"/>
-</sphinx:schema>
-"""
+%s</sphinx:schema>
+
+""" % change
+
+def xmlpipe2_footer():
+    return '</sphinx:docset>\n'
+
+headers = {
+    'sql': sql_header,
+    'pgcopy': pgcopy_header,
+    'xmlpipe2': xmlpipe2_header,
+}
+
+footers = {
+    'pgcopy': pgcopy_footer,
+    'xmlpipe2': xmlpipe2_footer,
+}
+
+
+## Formats written by a sink object rather than as text on stdout. Each
+## entry builds the sink from the command line arguments; the sink takes
+## records through write() and finishes up in close().
+search_columns = ['title', 'subtitle', 'author', 'topical_terms']
+
+def sqlite_sink(args):
+    if not args.db:
+        sys.exit('sqlite mode needs --db')
+    return SQLiteSink(args.db, table_fields(), dict((f, 'integer') for f in ('docid', 'page_count')),
+                      multi_valued, search_columns, key='docid' if delta else None)
+
+# low-cardinality columns, stored as small ints by the columns mode.
+categorical = ['lang', 'country', 'type', 'music_form', 'music_score',
+               'video_technique', 'governing_source', 'change', 'duplicate']
+
+def pub_year(record):
+    return safeint(record.get('pub_date', '')[:4]) or None
+
+def columns_sink(args):
+    if not args.outdir:
+        sys.exit('columns mode needs --outdir')
+    return ColumnSink(args.outdir, fields, categorical, ['page_count'],
+                      {'pub_year': pub_year})
+
+sinks = {
+    'sqlite': sqlite_sink,
+    'columns': columns_sink,
+}
+
+## Sharded output (--shards): records are spread over n files by a hash of
+## one column, so n loaders or indexers can each take one. A format whose
+## header and footer are a schema to create once (sql, pgcopy) gets them in
+## files of their own, to run before and after the shards are loaded; the
+## xmlpipe2 ones go into every shard, which is a whole Sphinx source.
+self_contained = ['xmlpipe2']
+
+# shard keys that are computed rather than read from the record.
+shard_keys = {
+    'pub_year': pub_year,
+}
+
+def shard_columns(key):
+    """The columns a record needs for its shard to be found by key."""
+    return ['pub_date'] if key == 'pub_year' else [key]
+
+class ShardWriter:
+    """Writes records encoded for mode to prefix-00.mode ... in n shards,
+    by the crc32 of their key column, and lists the shards with their
+    record counts in prefix-manifest.json on close(). The columns in drop
+    were read only to find the shard, and are taken out before writing
+    (except from deleted stubs, as in drop_columns)."""
+
+    def __init__(self, prefix, mode, n, key='docid', drop=()):
+        self.prefix = prefix
+        self.mode = mode
+        self.n = n
+        self.key = key
+        self.drop = drop
+        self.value = shard_keys.get(key, lambda record: record.get(key))
+        width = max(2, len(str(n - 1)))
+        self.paths = ['%s-%0*d.%s' % (prefix, width, i, mode) for i in range(n)]
+        framed = mode in self_contained
+        self.sinks = [TextSink(path, mode, framed=framed) for path in self.paths]
+        self.counts = [0] * n
+        self.extra = {}
+        if framed:
+            return
+        for name, parts in (('header', headers), ('footer', footers)):
+            if mode in parts:
+                # run on their own, before and after the shards are loaded.
+                path = '%s-%s.%s' % (prefix, name, mode)
+                with open(path, 'wb') as f:
+                    if mode == 'pgcopy':
+                        f.write(parts[mode](transaction=False))
+                    else:
+                        f.write(parts[mode]())
+                self.extra[name] = path
+
+    def shard(self, record):
+        v = self.value(record)
+        if isinstance(v, list):
+            v = ' '.join(v)
+        return zlib.crc32(str(v if v is not None else '')) % self.n
+
+    def write(self, record):
+        i = self.shard(record)
+        self.counts[i] += 1
+        if self.drop and record.get('change') != 'deleted':
+            for c in self.drop:
+                record.pop(c, None)
+        self.sinks[i].write(record)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        manifest = {
+            'mode': self.mode,
+            'key': self.key,
+            'records': sum(self.counts),
+            'shards': [{'path': path, 'records': count, 'bytes': os.path.getsize(path)}
+                       for path, count in zip(self.paths, self.counts)],
+        }
+        manifest.update(self.extra)
+        with open(self.prefix + '-manifest.json', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+## Fan-out (--out mode:path, as many times as wanted): every record is
+## converted once and goes to each output. An output runs on a thread of
+## its own behind a queue of record blocks, encoding and writing through
+## its own buffered file, so the outputs overlap one another, and a slow
+## one only holds up the rest once PIPELINE_DEPTH blocks are waiting on it.
+
+# the argument a sink takes its path from.
+sink_paths = {
+    'sqlite': 'db',
+    'columns': 'outdir',
+}
+
+def gzip_level(args):
+    """The level to gzip text output at, or None to leave it uncompressed."""
+    return (args.compress_level or 6) if args.compress else None
+
+class TextSink:
+    """Writes records encoded for mode to path ('-' for stdout) through a
+    buffer of BUFFER bytes, between the mode's header and footer if framed.
+    With level, a GzipBlockWriter compresses it at that level; with
+    pipeline, a WriteBehind does the writing; with stats, the encoding is
+    counted as serialize."""
+
+    BUFFER = 1 << 20
+
+    def __init__(self, path, mode, level=None, pipeline=False, framed=True, stats=None):
+        self.mode = mode
+        self.framed = framed
+        self.stats = stats
+        self.file = sys.stdout if path == '-' else open(path, 'wb', self.BUFFER)
+        self.behind = self.out = WriteBehind(self.file) if pipeline else self.file
+        if level:
+            # the block index only goes with a named output file.
+            index = path + BLOCK_INDEX if path != '-' else None
+            self.out = GzipBlockWriter(self.behind, level, index=index)
+        self.batch = [] if mode in batch_encoders else None
+        if framed and mode in headers:
+            self.out.write(headers[mode]())
+
+    def write(self, record):
+        if self.batch is None:
+            self.out.write(timed(encoders[self.mode], record, self.stats))
+            return
+        self.batch.append(record)
+        if len(self.batch) == ENCODE_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.out.write(timed(batch_encoders[self.mode], self.batch, self.stats,
+                                 len(self.batch)))
+            self.batch = []
+
+    def copy(self, f):
+        """Write out the contents of f, already encoded for mode."""
+        self.flush()
+        shutil.copyfileobj(f, self.out, 1 << 20)
+
+    def close(self):
+        self.flush()
+        if self.framed and self.mode in footers:
+            self.out.write(footers[self.mode]())
+        if self.out is not self.behind:
+            self.out.close()
+        if self.behind is not self.file:
+            self.behind.close()
+        if self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
+class Branch(Consumer):
+    """One output of a FanOut, on its own thread. The sink is made on that
+    thread too, since a SQLite connection can only be used by the thread
+    that opened it. An error is raised by the next put() or close().
+
+    The columns in drop are left out of the records written, which other
+    branches share, so they are copied first (deleted stubs are left whole,
+    as in drop_columns)."""
+
+    def __init__(self, mode, path, args, drop=()):
+        self.mode = mode
+        self.path = path
+        self.args = args
+        self.drop = drop
+        Consumer.__init__(self)
+
+    def setup(self):
+        if self.mode in sinks:
+            args = argparse.Namespace(**vars(self.args))
+            setattr(args, sink_paths[self.mode], self.path)
+            self.sink = sinks[self.mode](args)
+        else:
+            self.sink = TextSink(self.path, self.mode, gzip_level(self.args))
+
+    def handle(self, block):
+        drop = self.drop
+        for record in block:
+            if drop and record.get('change') != 'deleted':
+                record = dict([kv for kv in record.iteritems() if kv[0] not in drop])
+            self.sink.write(record)
+
+    def finish(self):
+        self.sink.close()
+
+class FanOut:
+    """Hands every record written to it to each of outputs, a list of
+    (mode, path), in blocks of PIPELINE_BLOCK records. The docid is left
+    out, with unkeyed, from the outputs that aren't keyed by it."""
+
+    def __init__(self, outputs, args, unkeyed=()):
+        self.branches = [Branch(mode, path, args,
+                                () if keyed(mode, args.state) else unkeyed)
+                         for mode, path in outputs]
+        self.block = []
+
+    def write(self, record):
+        self.block.append(record)
+        if len(self.block) == PIPELINE_BLOCK:
+            self.flush()
+
+    def flush(self):
+        if self.block:
+            for branch in self.branches:
+                branch.put(self.block)
+            self.block = []
+
+    def close(self):
+        self.flush()
+        for branch in self.branches:
+            branch.close()
+
+
+def select_columns(columns):
+    """Narrow the column list of the table formats to columns."""
+    global fields
+    fields = [f for f in fields if f in columns]
+
+
+def encode_records(mode, records, stats=None):
+    """Encode a stream of records, yielding chunks of text. With stats, the
+    time spent encoding is counted as serialize."""
+    if mode in batch_encoders:
+        encode = batch_encoders[mode]
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == ENCODE_BATCH:
+                yield timed(encode, batch, stats, len(batch))
+                batch = []
+        if batch:
+            yield timed(encode, batch, stats, len(batch))
+    else:
+        encode = encoders[mode]
+        for record in records:
+            yield timed(encode, record, stats)
+
+def timed(encode, records, stats, n=1):
+    if stats is None:
+        return encode(records)
+    t = time.time()
+    text = encode(records)
+    stats.add('serialize', time.time() - t, n)
+    return text
+
+
+def encode_file(f, mode, opts, span=None):
+    """Convert one input file, or one byte range of it, in a worker process.
+    The output goes to a temporary file, whose name is returned to the
+    parent: text encoded for mode, or marshalled records if mode is None."""
+    fd, path = tempfile.mkstemp(prefix='marc-', suffix='.' + (mode or 'records'))
+    out = os.fdopen(fd, 'wb')
+    stats = meter if opts.get('stats') else None
+    try:
+        records = process_file(f, span=span, **opts)
+        if mode is None:
+            for record in records:
+                marshal.dump(record, out)
+        else:
+            for chunk in encode_records(mode, records, stats):
+                out.write(chunk)
+    finally:
+        out.close()
+    if stats:
+        stats.post()
+    return path
+
+def start_worker(shared, slots):
+    """Pool initializer for --stats: take the next slot of shared to post
+    this worker's totals to."""
+    with slots.get_lock():
+        slot = slots.value
+        slots.value += 1
+    meter.begin(0)
+    meter.publish(shared, slot)
+
+def read_records(path):
+    """The records marshalled into path by encode_file."""
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+# don't cut files into pieces smaller than this.
+MIN_SPLIT = 1 << 20
+
+def plan_tasks(files, jobs, split):
+    """Break the inputs into (file, span) tasks in serial output order.
+    With split, large files are cut at record boundaries into pieces of
+    about total/(2*jobs) bytes, so one big file can use every worker."""
+    if not split:
+        return [(f, None) for f in files]
+    sizes = [os.path.getsize(f) for f in files]
+    piece = max(sum(sizes) // (2 * jobs), MIN_SPLIT)
+    tasks = []
+    for f, size in zip(files, sizes):
+        if isStreamed(f):
+            tasks.append((f, None))
+            continue
+        for span in splitFile(f, int(round(float(size) / piece)) or 1):
+            tasks.append((f, span))
+    return tasks
+
+def task_size(f, span):
+    return span[1] - span[0] if span else os.path.getsize(f)
+
+def convert_parallel(files, mode, opts, jobs, split=False):
+    """Convert files on a pool of jobs processes. Yields the name of each
+    task's output file (see encode_file) in the same order as a serial
+    run; each file is removed once the caller moves on to the next."""
+    tasks = plan_tasks(files, jobs, split)
+    if opts.get('stats'):
+        shared = meter.share(jobs)
+        pool = multiprocessing.Pool(jobs, start_worker,
+                                    (shared, multiprocessing.Value('i', 0)))
+        meter.watch()
+    else:
+        pool = multiprocessing.Pool(jobs)
+    results = [None] * len(tasks)
+    try:
+        # biggest first, so a large task doesn't start last and run alone.
+        order = sorted(range(len(tasks)), key=lambda i: task_size(*tasks[i]),
+                       reverse=True)
+        for i in order:
+            f, span = tasks[i]
+            results[i] = pool.apply_async(encode_file, (f, mode, opts, span))
+        pool.close()
+        for i in range(len(tasks)):
+            path = results[i].get()
+            try:
+                yield path
+            finally:
+                os.remove(path)
+        pool.join()
+    finally:
+        meter.unwatch()
+        pool.terminate()
+        for result in results:
+            if result is not None and result.ready() and result.successful():
+                if os.path.exists(result.get()):
+                    os.remove(result.get())
+
+def convert_records(files, opts, jobs=1, split=False):
+    """All the records of files, in order, converted on jobs processes."""
+    if jobs > 1:
+        for path in convert_parallel(files, None, opts, jobs, split):
+            for record in read_records(path):
+                yield record
+    else:
         for f in files:
-            for record in process_file(f, 50000):
-                r = {
-                    'docid': '',
-                    'title': '',
-                    'pub_date': '',
-                    'subtitle': '',
-                    'alt_title': '',
-                    'title_abbr': '',
-                    'type': '',
-                    'author': '',
-                    'author2': '',
-                    'publisher': '',
-                    'corporate_name': '',
-                    'country': '',
-                    'lang': '',
-                    'isbn': '',
-                    'invalid_isbn': '',
-                    'physical_desc': '',
-                    'physical_desc_2': '',
-                    'topical_terms': '',
-                    'topical_terms_2': '',
-                    'genre': '',
-                    'general_note': '',
-                    'series': '',
-                    'series2': '',
-                    'subject_personal_name': ''
-                }
-                r.update(record)
-
-                for k, v in r.iteritems():
-                    if type(v) == type([]):
-                        r[k] = ' '.join(v)
-                    r[k] = cgi.escape(str(r[k]))
-
-                print """
-<sphinx:document id="{docid}">
-<title>{title} {subtitle} {alt_title} {title_abbr}</title>
-<type>{type}</type>
-<date>{pub_date}</date>
-<author>{author} {author2}</author>
-<publisher>{publisher} {corporate_name}</publisher>
-<country>{country}</country>
-<lang>{lang}</lang>
-<isbn>{isbn} {invalid_isbn}</isbn>
-<misc>{physical_desc} {physical_desc_2} {topical_terms} {topical_terms_2} {genre} {general_note} {series} {series2} {subject_personal_name}</misc>
-</sphinx:document>
-""".format(**r)
+            for record in process_file(f, **opts):
+                yield record
+
+def dedup_records(records, dedup, drop=False):
+    """Drop each record that repeats the docid or a system control number
+    of an earlier one, or with drop False, name the repeated columns in
+    its duplicate column."""
+    for record in records:
+        duplicates = dedup.check(record)
+        if duplicates:
+            if drop:
+                continue
+            record['duplicate'] = ','.join(duplicates)
+        yield record
+
+def delta_records(records, state):
+    """The records that are new or changed since state was saved, with their
+    change column set, then a stub record for each one deleted since."""
+    for record in records:
+        change = state.check(record)
+        if change:
+            record['change'] = change
+            yield record
+    for id in state.deleted():
+        yield {'id': id, 'docid': id[0:9], 'change': 'deleted'}
+
+def drop_columns(records, columns):
+    """Take out the columns that were read only to match records by. The
+    stubs of deleted records (see delta_records) are left whole: the id is
+    all they have to say."""
+    for record in records:
+        if record.get('change') != 'deleted':
+            for c in columns:
+                record.pop(c, None)
+        yield record
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(usage="""
+    marc.py sql|pgcopy|sqlite|columns|json|ndjson|tsv|xmlpipe2 [options] [input ...]
+    marc.py --out MODE:PATH [--out MODE:PATH ...] [options] [input ...]
+""")
+    modes = sorted(set(encoders) | set(batch_encoders) | set(sinks))
+    # not a choices list: with --out, the first input lands here.
+    parser.add_argument('mode', nargs='?', help=', '.join(modes))
+    parser.add_argument('--mmap', action='store_true',
+                        help='mmap input files and parse records in place')
+    parser.add_argument('--index', action='store_true',
+                        help='build or use a .idx offset index next to each input')
+    parser.add_argument('--start', type=int, default=0,
+                        help='skip to this record number in each input')
+    parser.add_argument('--count', type=int,
+                        help='convert at most this many records per input')
+    parser.add_argument('--batch', type=int, default=0,
+                        help='parse records in batches of this many, decoding '
+                             'their directories together (faster with NumPy)')
+    parser.add_argument('--columns',
+                        help='comma-separated list of columns to output (default: all)')
+    parser.add_argument('--intern', action='store_true',
+                        help='share one copy of repeated code values between records '
+                             'and report the bytes saved (not with --jobs)')
+    parser.add_argument('--db', help='database file for the sqlite mode')
+    parser.add_argument('--outdir', help='output directory for the columns mode')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='convert on this many processes, splitting large '
+                             'input files into byte ranges where possible')
+    parser.add_argument('--state',
+                        help='export only the records new, changed or deleted since '
+                             'the run that wrote this state file, then update it')
+    parser.add_argument('--dedup', choices=['flag', 'drop'],
+                        help='flag or drop records repeating an earlier docid '
+                             'or 035a system control number')
+    parser.add_argument('--dedup-memory', type=int, default=256,
+                        help='megabytes for the --dedup tables (default: 256)')
+    parser.add_argument('--stats', action='store_true',
+                        help='time each stage and report progress on stderr, '
+                             'then a summary')
+    parser.add_argument('--stats-interval', type=float, default=10.0, metavar='SECONDS',
+                        help='seconds between --stats progress reports (default: 10)')
+    parser.add_argument('--where',
+                        help='convert only records matching this filter on the leader, '
+                             'directory and control fields, eg. '
+                             '"leader.type_of_record=e and has:020"')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='write this many output files instead of stdout, '
+                             'spreading records by a hash of --shard-by')
+    parser.add_argument('--shard-by', default='docid',
+                        help='column to shard by (default: docid), or pub_year')
+    parser.add_argument('--prefix', default='out',
+                        help='path prefix of the --shards files (default: out)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='read, convert and write on separate threads')
+    parser.add_argument('--output', '-o',
+                        help='write the output to this file instead of stdout')
+    parser.add_argument('--compress', action='store_true',
+                        help='gzip the output in blocks compressed in parallel')
+    parser.add_argument('--compress-level', type=int, metavar='LEVEL', choices=range(1, 10),
+                        help='the gzip level for --compress, 1-9 (default: 6)')
+    parser.add_argument('--out', action='append', metavar='MODE:PATH',
+                        help='write MODE output to PATH (a file, - for stdout, or the '
+                             'database or directory of the sqlite and columns modes); '
+                             'give it once for each output to write in one pass')
+    # the inputs are whatever is left over, so they may come before, after
+    # or between the options (argparse would only take one run of them).
+    args, args.input = parser.parse_known_args()
+    unknown = [a for a in args.input if a.startswith('-') and a != '-']
+    if unknown:
+        parser.error('unrecognized arguments: %s' % ' '.join(unknown))
+    outputs = []
+    if args.out:
+        if args.mode in modes:
+            parser.error('with --out, give each output as --out MODE:PATH '
+                         '(--out %s:- for stdout)' % args.mode)
+        if args.mode is not None:
+            args.input.insert(0, args.mode)
+            args.mode = None
+        for spec in args.out:
+            mode, _, path = spec.partition(':')
+            if mode not in modes or not path:
+                parser.error('--out wants MODE:PATH, with MODE one of %s: %r'
+                             % (', '.join(modes), spec))
+            outputs.append((mode, path))
+        if args.output or args.shards:
+            parser.error('--out replaces --output and --shards')
+    elif args.mode not in modes:
+        parser.error('argument mode: invalid choice: %r (choose from %s)'
+                     % (args.mode, ', '.join(modes)))
+    if args.compress_level and not args.compress:
+        parser.error('--compress-level needs --compress')
+    if (args.output or args.compress) and (args.mode in sinks or args.shards):
+        parser.error('--output and --compress are for modes that write to '
+                     'stdout, without --shards')
+    if args.shards:
+        if args.mode in sinks:
+            parser.error('--shards does not apply to the %s mode' % args.mode)
+        if args.shard_by not in fields and args.shard_by not in shard_keys:
+            parser.error('unknown --shard-by column: ' + args.shard_by)
+    # records that aren't read would all be taken as deleted.
+    if args.state and (args.start or args.count is not None or args.where):
+        parser.error('--state needs whole inputs: no --start, --count or --where')
+
+    if args.input:
+        files = args.input
+    else:
+        files = (glob.glob('data/hlom/*.mrc') + glob.glob('data/hlom/*.mrc.gz') +
+                 glob.glob('data/hlom/*.mrc.bz2') + glob.glob('data/hlom/*.mrc.xz'))
+    if '-' in files and args.jobs > 1:
+        parser.error("stdin ('-') can't be read by --jobs workers")
+    if args.index and [f for f in files if not isIndexable(f)]:
+        parser.error("--index needs uncompressed or gzip input files")
+
+    # Sphinx only gets a sample of each file unless told otherwise.
+    lim = args.count
+    if lim is None and args.mode == 'xmlpipe2' and not args.state:
+        lim = 50000
+    # records from --jobs workers come back through marshal, each value a
+    # copy of its own, so there is nothing to share.
+    opts = dict(lim=lim, mapped=args.mmap, start=args.start, indexed=args.index,
+                batch=args.batch, intern=args.intern and args.jobs == 1,
+                stats=args.stats, where=args.where, pipeline=args.pipeline)
+    if args.where:
+        try:
+            compileFilter(args.where)
+        except ValueError, e:
+            parser.error(str(e))
+    stats = None
+    if opts['stats']:
+        stats = meter
+        stats.interval = args.stats_interval
+        stats.begin(sum([os.path.getsize(f) for f in files if f != '-']))
+
+    # columns extracted for matching records, for finding their shard, or
+    # for the outputs that are keyed by docid, but not wanted in the output.
+    hidden = []
+    unsharded = []
+    unkeyed = []
+    if args.columns:
+        columns = args.columns.split(',')
+        unknown = set(columns) - set(fields)
+        if unknown:
+            parser.error('unknown columns: ' + ', '.join(sorted(unknown)))
+        select_columns(columns)
+        # --state matches records by id, and --dedup by docid and 035a.
+        needed = (['id'] if args.state else []) + \
+                 (['docid', 'system_control_number'] if args.dedup else [])
+        if args.shards:
+            needed += shard_columns(args.shard_by)
+        targets = [mode for mode, path in outputs] or [args.mode]
+        keys = [mode for mode in targets if keyed(mode, args.state)]
+        if keys:
+            needed.append('docid')
+        opts['columns'] = columns + [c for c in set(needed) if c not in columns]
+        hidden = [c for c in set(needed) if c not in columns]
+        if keys and 'docid' in hidden:
+            # kept for the keyed outputs; the others take it out (see Branch).
+            hidden.remove('docid')
+            unkeyed = ['docid']
+        if args.shards:
+            # ShardWriter takes these out once it has used them.
+            unsharded = [c for c in hidden if c in shard_columns(args.shard_by)]
+            hidden = [c for c in hidden if c not in unsharded]
+    if args.dedup:
+        if args.dedup == 'flag':
+            fields.append('duplicate')
+        dedup = Dedup(args.dedup_memory << 20)
+    if args.state:
+        fields.append('change')
+        delta = os.path.exists(args.state)
+        state = DeltaState(args.state)
+    # a file can only be cut into byte ranges when every record of it is
+    # wanted; --start, --count and --index all count records from its start.
+    split = lim is None and not args.start and not args.index
+
+    records = convert_records(files, opts, args.jobs, split)
+    if args.dedup:
+        records = dedup_records(records, dedup, args.dedup == 'drop')
+    if args.state:
+        records = delta_records(records, state)
+    if hidden:
+        records = drop_columns(records, hidden)
+
+    if outputs:
+        fanout = FanOut(outputs, args, unkeyed)
+        for record in records:
+            fanout.write(record)
+        fanout.close()
+
+    elif args.mode in sinks or args.shards:
+        if args.shards:
+            sink = ShardWriter(args.prefix, args.mode, args.shards, args.shard_by,
+                               unsharded)
+        else:
+            sink = sinks[args.mode](args)
+        for record in records:
+            timed(sink.write, record, stats)
+        sink.close()
+
+    else:
+        out = TextSink(args.output or '-', args.mode, gzip_level(args),
+                       pipeline=args.pipeline, stats=stats)
+        if args.jobs > 1 and not (args.dedup or args.state):
+            # the workers encode, and their output is copied as it is.
+            for path in convert_parallel(files, args.mode, opts, args.jobs, split):
+                with open(path, 'rb') as part:
+                    out.copy(part)
+        else:
+            for record in records:
+                out.write(record)
+        out.close()
 
-        print """</sphinx:docset>"""
+    if stats:
+        stats.summary()
+    if args.dedup:
+        print >> sys.stderr, 'duplicates: %(docid)d docid, ' \
+            '%(system_control_number)d system control number' % dedup.counts
+    if args.state:
+        # only once the delta is out, so a failed run can be repeated.
+        state.save()
+        print >> sys.stderr, 'delta: %(new)d new, %(changed)d changed, ' \
+            '%(deleted)d deleted, %(unchanged)d unchanged' % state.counts
@@ -1,5 +1,26 @@
 import types
-import string
+import mmap
+import os
+import sys
+import struct
+import zlib
+import bz2
+import bisect
+import re
+import shlex
+from array import array
+import gzindex
+try:
+    import numpy
+except ImportError:
+    numpy=None
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma=None
 
 #-- Version 1.0.1
 #-- November 1, 2000
@@ -18,8 +39,15 @@ class MARC21Record:
     FIELD_TERMINATOR=chr(30)
     RECORD_TERMINATOR=chr(29)
 
-    def __init__(self,data=None):
+    def __init__(self,data=None,offset=0,lazy=False):
         self.dataFields={}
+        #-- In lazy mode only the leader and directory are parsed up front.
+        #-- pending maps each tag not yet decoded to its directory entries,
+        #-- and fieldData/base locate the field data they point into.
+        self.lazy=lazy
+        self.pending={}
+        self.fieldData=None
+        self.base=0
         self.record_status=' '
         self.type_of_record=' '
         self.implementation_defined1='  '
@@ -32,13 +60,38 @@ class MARC21Record:
         self.subfield_code_length=2
 
         if data is not None:
-            self.parse(data)
+            self.parse(data,offset)
 
-    def parse(self,data):
+    def parse(self,data,offset=0):
+        #-- data may be a string holding the record, or any buffer that
+        #-- supports find() and slicing (eg. an mmap of a whole file), in
+        #-- which case the record is read in place starting at offset.
         #-- Extract the leader from the data.
-        leaderData=data[:24]
-        data=data[24:]
+        self.parseLeader(data[offset:offset+24])
+
+        #-- Now, read the remaining data until a FIELD_TERMINATOR.
+        #-- This data will be the directory.  Field offsets are relative
+        #-- to the byte following it.
+        FTindex=data.find(MARC21Record.FIELD_TERMINATOR,offset+24)
+        directoryData=data[offset+24:FTindex]
 
+        #-- Parse the directory.
+        directory={}
+        for i in xrange(0,len(directoryData),12):
+            tag=directoryData[i:i+3]
+            fieldLength=int(directoryData[i+3:i+7])
+            fieldOffset=int(directoryData[i+7:i+12])
+            if directory.has_key(tag):
+                if type(directory[tag])==type([]):
+                    directory[tag].append((fieldLength,fieldOffset))
+                else:
+                    directory[tag]=[directory[tag],(fieldLength,fieldOffset)]
+            else:
+                directory[tag]=(fieldLength,fieldOffset)
+
+        self.load(data,FTindex+1,directory)
+
+    def parseLeader(self,leaderData):
         try:
             #-- Read the fields in the leader and modify the state of the object.
             lengthOfRecord=int(leaderData[:5])
@@ -54,56 +107,57 @@ class MARC21Record:
         except:
             print leaderData
             raise
-        #-- Now, read the remaining data until a FIELD_TERMINATOR.
-        #-- This data will be the directory.
-        FTindex=string.find(data,MARC21Record.FIELD_TERMINATOR)
-        directoryData=data[:FTindex]
-        data=data[FTindex+1:]
 
-        #-- Parse the directory.
-        directory={}
-        while len(directoryData)>0:
-            directoryEntry=directoryData[:12]
-            tag=directoryData[:3]
-            fieldLength=int(directoryData[3:7])
-            fieldOffset=int(directoryData[7:12])
-            if directory.has_key(tag):
-                if type(directory[tag])==type([]):
-                    directory[tag].append((fieldLength,fieldOffset))
-                else:
-                    directory[tag]=[directory[tag],(fieldLength,fieldOffset)]
-            else:
-                directory[tag]=(fieldLength,fieldOffset)
-            directoryData=directoryData[12:]
+    def load(self,data,base,directory):
+        #-- Now, use the directory to read in the following data, either
+        #-- all of it now or each tag the first time it is asked for.
+        self.fieldData=data
+        self.base=base
+        self.pending=directory
+        if not self.lazy:
+            self.decodeAll()
 
-        #-- Now, use the directory to read in the following data.
-        for tag in directory.keys():
-            directoryEntries=[]
-            if type(directory[tag])==type([]):
-                directoryEntries=directory[tag]
+    def decode(self,tag):
+        directoryEntries=self.pending.pop(tag)
+        if type(directoryEntries)!=type([]):
+            directoryEntries=[directoryEntries]
+        data=self.fieldData
+        base=self.base
+        for directoryEntry in directoryEntries:
+            fieldLength,fieldOffset=directoryEntry
+            fieldData=data[base+fieldOffset:base+fieldOffset+fieldLength]
+            if tag[:2]=='00':
+                taggedData=fieldData[:-1]
             else:
-                directoryEntries=[directory[tag]]
-            for directoryEntry in directoryEntries:
-                fieldLength,fieldOffset=directoryEntry
-                fieldData=data[fieldOffset:fieldOffset+fieldLength]
-                if tag[:2]=='00':
-                    taggedData=fieldData[:-1]
+                taggedData=MARC21DataField(fieldData)
+            if self.dataFields.has_key(tag):
+                if type(self.dataFields[tag])==type([]):
+                    self.dataFields[tag].append(taggedData)
                 else:
-                    taggedData=MARC21DataField(fieldData)
-                if self.dataFields.has_key(tag):
-                    if type(self.dataFields[tag])==type([]):
-                        self.dataFields[tag].append(taggedData)
-                    else:
-                        self.dataFields[tag]=[self.dataFields[tag],taggedData]
-                else:
-                    self.dataFields[tag]=taggedData
+                    self.dataFields[tag]=[self.dataFields[tag],taggedData]
+            else:
+                self.dataFields[tag]=taggedData
+        #-- Let go of the raw record once nothing refers to it.
+        if not self.pending:
+            self.fieldData=None
+
+    def decodeAll(self):
+        for tag in self.pending.keys():
+            self.decode(tag)
+
     def fields(self):
-        return self.dataFields.keys()
+        return self.dataFields.keys()+self.pending.keys()
+
+    def __contains__(self,tag):
+        return tag in self.dataFields or tag in self.pending
 
     def __getitem__(self,tag):
+        if tag in self.pending:
+            self.decode(tag)
         return self.dataFields[tag]
 
     def __setitem__(self,tag,value):
+        self.pending.pop(tag,None)
         if tag[:2]=='00':
             if type(value)!=types.StringType:
                 #-- 00x tags are control fields.  They have no subfields,
@@ -124,54 +178,56 @@ class MARC21Record:
         return self.__str__()
 
     def __str__(self):
-        #-- Serialize all of the data fields and build the directory.
-        data=""
-        directory={}
-        sortedFields=self.dataFields.keys()
-        sortedFields.sort()
-        for field in sortedFields:
-            if type(self.dataFields[field])==type([]):
-                contentList=self.dataFields[field]
+        self.decodeAll()
+        return self.serialize()
+
+    def serialize(self):
+        #-- Serialize the data fields and build the directory in one pass,
+        #-- collecting the pieces of each and joining them once.  Fields
+        #-- still pending (see lazy) are copied from the raw record as they
+        #-- are, so a record that was only read comes out as it went in.
+        data=[]
+        directory=[]
+        offset=0
+        dataFields=self.dataFields
+        pending=self.pending
+        for field in sorted(dataFields.keys()+pending.keys()):
+            if field in pending:
+                entries=pending[field]
+                if type(entries)!=type([]):
+                    entries=[entries]
+                raw=self.fieldData
+                base=self.base
+                contentList=[raw[base+fieldOffset:base+fieldOffset+fieldLength]
+                             for fieldLength,fieldOffset in entries]
             else:
-                contentList=[self.dataFields[field]]
-            for content in contentList:
-                offset=len(data)
+                contentList=dataFields[field]
+                if type(contentList)!=type([]):
+                    contentList=[contentList]
                 if field[:2]=='00':
-                    serializedField=content+MARC21Record.FIELD_TERMINATOR
-                else:
-                    serializedField='%s'%(content)
+                    contentList=[content+MARC21Record.FIELD_TERMINATOR
+                                 for content in contentList]
+            for content in contentList:
+                serializedField='%s'%(content)
                 length=len(serializedField)
-                if directory.has_key(field):
-                    directory[field].append((length,offset))
-                else:
-                    directory[field]=[(length,offset)]
-                data=data+serializedField
-
-        #-- Add the record terminator.
-        data=data+MARC21Record.RECORD_TERMINATOR
+                directory.append("%3s%04d%05d"%(field[:3],length,offset))
+                data.append(serializedField)
+                offset=offset+length
 
-        #-- Now, serialize the directory.
-        directoryData=""
-        for field in sortedFields:
-            for directoryEntry in directory[field]:
-                length,offset=directoryEntry
-                directoryData=directoryData+"%3s%04d%05d"%(field[:3],length,offset)
-        directoryData=directoryData+MARC21Record.FIELD_TERMINATOR
+        #-- Add the record terminator, and end the directory.
+        data.append(MARC21Record.RECORD_TERMINATOR)
+        directory.append(MARC21Record.FIELD_TERMINATOR)
+        directoryData=''.join(directory)
 
-        recordLength=24+len(directoryData)+len(data)
         baseAddressOfData=24+len(directoryData)
-        leaderData="%05d"%(recordLength)
-        leaderData=leaderData+self.record_status[:1]
-        leaderData=leaderData+self.type_of_record[:1]
-        leaderData=leaderData+self.implementation_defined1[:2]
-        leaderData=leaderData+self.character_coding_scheme[:1]
-        leaderData=leaderData+"%01d"%(self.indicator_count)
-        leaderData=leaderData+"%01d"%(self.subfield_code_length)
-        leaderData=leaderData+"%05d"%(baseAddressOfData)
-        leaderData=leaderData+self.implementation_defined2[:3]
-        leaderData=leaderData+self.entry_map[:4]
-
-        return leaderData+directoryData+data
+        recordLength=baseAddressOfData+offset+1
+        leaderData="%05d%s%s%s%s%01d%01d%05d%s%s"%(recordLength,
+            self.record_status[:1],self.type_of_record[:1],
+            self.implementation_defined1[:2],self.character_coding_scheme[:1],
+            self.indicator_count,self.subfield_code_length,baseAddressOfData,
+            self.implementation_defined2[:3],self.entry_map[:4])
+
+        return leaderData+directoryData+''.join(data)
 
 class MARC21DataField:
     SUBFIELD_DELIMITER=chr(31)
@@ -187,6 +243,9 @@ class MARC21DataField:
     def subfields(self):
         return self.contents.keys()
 
+    def __contains__(self,subfield):
+        return subfield in self.contents
+
     def __getitem__(self,subfield):
         return self.contents[subfield]
 
@@ -197,15 +256,8 @@ class MARC21DataField:
         #-- Read the indicators.
         self.indicator1=data[0]
         self.indicator2=data[1]
-        data=data[3:]
-        #-- Strip the FIELD_DELIMITER
-        data=data[:-1]
-        while len(data)>0:
-            SDindex=string.find(data,MARC21DataField.SUBFIELD_DELIMITER)
-            if SDindex<0:
-                SDindex=len(data)
-            subfieldData=data[:SDindex]
-            data=data[SDindex+1:]
+        #-- Skip the first SUBFIELD_DELIMITER and strip the FIELD_TERMINATOR.
+        for subfieldData in data[3:-1].split(MARC21DataField.SUBFIELD_DELIMITER):
             if not subfieldData:
                 continue
             if self.contents.has_key(subfieldData[0]):
@@ -217,29 +269,319 @@ class MARC21DataField:
                 self.contents[subfieldData[0]]=subfieldData[1:]
 
     def __str__(self):
-        data=self.indicator1[0]+self.indicator2[0]
-        sortedSubfields=self.contents.keys()
-        sortedSubfields.sort()
-        for subfield in sortedSubfields:
-            if type(self.contents[subfield])==type([]):
-                contentList=self.contents[subfield]
-            else:
-                contentList=[self.contents[subfield]]
+        data=[self.indicator1[0]+self.indicator2[0]]
+        contents=self.contents
+        for subfield in sorted(contents):
+            contentList=contents[subfield]
+            if type(contentList)!=type([]):
+                contentList=[contentList]
+            prefix=MARC21DataField.SUBFIELD_DELIMITER+subfield
             for content in contentList:
-                data=data+MARC21DataField.SUBFIELD_DELIMITER+subfield+content
-        data=data+MARC21Record.FIELD_TERMINATOR
+                data.append(prefix+content)
+        data.append(MARC21Record.FIELD_TERMINATOR)
+        return ''.join(data)
+
+class MARC21Writer:
+    #-- Writes MARC21Records in bulk, to a file given by name or to any
+    #-- object with a write() method (eg. sys.stdout).  Records are
+    #-- serialized as they come and written out batch at a time, each
+    #-- batch in a single write(); the output reads back with MARC21File.
+    #-- Lazy records are written without decoding the fields they still
+    #-- have pending, which are copied through byte for byte.
+    def __init__(self,target,batch=1000):
+        if hasattr(target,'write'):
+            self.file=target
+            self.owned=False
+        else:
+            self.file=open(target,'wb')
+            self.owned=True
+        self.batch=batch
+        self.buffer=[]
+        self.count=0
+
+    def write(self,record):
+        self.writeRaw(record.serialize())
+
+    def writeRaw(self,data):
+        #-- Write an already serialized record as it is.
+        self.buffer.append(data)
+        self.count=self.count+1
+        if len(self.buffer)>=self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer=[]
+
+    def close(self):
+        self.flush()
+        if self.owned:
+            self.file.close()
+        else:
+            self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+#-- Compressed input, recognized by its first bytes: the magic number and
+#-- a function making a decompressor for each format.
+def gzipDecompressor():
+    return zlib.decompressobj(16+zlib.MAX_WBITS)
+
+COMPRESSED=[
+    ('\x1f\x8b',gzipDecompressor),
+    ('BZh',bz2.BZ2Decompressor),
+    ('\xfd7zXZ\x00',lzma and lzma.LZMADecompressor),
+]
+
+class BlockReader:
+    #-- A forward-only file over a stream that may be compressed: stdin,
+    #-- or a gzip, bzip2 or xz file.  The stream is read and decompressed
+    #-- BLOCK bytes at a time, and read(n) slices records out of what has
+    #-- been decompressed, so a record can straddle two blocks but the
+    #-- whole file is never held in memory.  tell() and seek() count
+    #-- uncompressed bytes; consumed counts the bytes read from the stream.
+    BLOCK=1<<20
+
+    def __init__(self,f,decompressor=None,data=''):
+        self.file=f
+        self.decompressor=decompressor
+        self.current=decompressor() if decompressor is not None else None
+        self.pending=data
+        self.consumed=0
+        self.buffer=''
+        self.pos=0
+        self.offset=0
+
+    def fill(self):
+        #-- Add the next block to the buffer.  False at the end.
+        while True:
+            raw=self.pending or self.file.read(BlockReader.BLOCK)
+            self.pending=''
+            if not raw:
+                return False
+            self.consumed=self.consumed+len(raw)
+            data=raw
+            if self.current is not None:
+                data=self.decompress(raw)
+            if data:
+                self.buffer=self.buffer[self.pos:]+data
+                self.offset=self.offset+self.pos
+                self.pos=0
+                return True
+
+    def decompress(self,raw):
+        #-- A file may hold several compressed streams one after the other
+        #-- (eg. from pigz, or cat a.gz b.gz); each gets a new decompressor.
+        try:
+            data=self.current.decompress(raw)
+        except EOFError:
+            self.current=self.decompressor()
+            return self.current.decompress(raw)
+        rest=self.current.unused_data
+        if rest:
+            self.current=self.decompressor()
+            data=data+self.decompress(rest)
+        return data
+
+    def read(self,n):
+        while len(self.buffer)-self.pos<n and self.fill():
+            pass
+        data=self.buffer[self.pos:self.pos+n]
+        self.pos=self.pos+len(data)
         return data
 
+    def tell(self):
+        return self.offset+self.pos
+
+    def seek(self,offset):
+        if offset<self.tell():
+            raise IOError("can't seek backwards in a stream")
+        while offset>self.tell() and self.read(min(offset-self.tell(),BlockReader.BLOCK)):
+            pass
+
+    def close(self):
+        if self.file is not sys.stdin:
+            self.file.close()
+
+def openInput(filename):
+    #-- Open filename for reading records: a plain file as it is, and stdin
+    #-- ('-') or a compressed file as a BlockReader.
+    if filename=='-':
+        f=sys.stdin
+        head=f.read(6)
+    else:
+        f=open(filename,'rb')
+        head=f.read(6)
+        f.seek(0)
+    for magic,decompressor in COMPRESSED:
+        if head.startswith(magic):
+            if decompressor is None:
+                raise IOError("reading %s needs the lzma module"%filename)
+            return BlockReader(f,decompressor,head if f is sys.stdin else '')
+    if f is sys.stdin:
+        return BlockReader(f,None,head)
+    return f
+
+class GzipSeeker:
+    #-- A gzip file with random access, given its MARC21GzipIndex.  It is
+    #-- read through a BlockReader like any compressed file, but seek()
+    #-- can go anywhere: it starts a new BlockReader at the last checkpoint
+    #-- before the offset, unless that is behind where reading has already
+    #-- got to, and reads forward from there.
+    def __init__(self,filename,index):
+        self.filename=filename
+        self.index=index
+        self.reader=None
+        self.restart(-1)
+
+    def restart(self,i):
+        #-- A new reader at checkpoint i, or the start of the file for -1.
+        f=open(self.filename,'rb')
+        reader=BlockReader(f,gzipDecompressor)
+        self.origin=0
+        if i>=0:
+            out,pos,bits,window=self.index.checkpoint(i)
+            byte=0
+            if bits:
+                f.seek(pos-1)
+                byte=ord(f.read(1))
+            else:
+                f.seek(pos)
+            reader.current=gzindex.Resume(bits,byte,window)
+            reader.offset=out
+            self.origin=pos
+        if self.reader is not None:
+            self.reader.close()
+        self.reader=reader
+
+    def read(self,n):
+        return self.reader.read(n)
+
+    def tell(self):
+        return self.reader.tell()
+
+    def seek(self,offset):
+        i=self.index.find(offset)
+        here=self.reader.tell()
+        if offset<here or (i>=0 and self.index.outs[i]>here):
+            self.restart(i)
+        self.reader.seek(offset)
+
+    def inputOffset(self):
+        #-- How far into the compressed file reading has got.
+        return self.origin+self.reader.consumed
+
+    def close(self):
+        self.reader.close()
+
+def isIndexable(filename):
+    #-- Whether MARC21File can index filename: a plain or gzip file.
+    if filename=='-':
+        return False
+    f=openInput(filename)
+    try:
+        return not isinstance(f,BlockReader) or f.decompressor is gzipDecompressor
+    finally:
+        f.close()
+
+def isStreamed(filename):
+    #-- Whether filename can only be read straight through (see openInput).
+    if filename=='-':
+        return True
+    f=openInput(filename)
+    try:
+        return isinstance(f,BlockReader)
+    finally:
+        f.close()
+
 class MARC21File:
-    def __init__(self,filename):
-        self.index=[0]
+    def __init__(self,filename,mapped=False,indexed=False,span=None,lazy=False):
+        #-- span=(start,end) limits the file to the records in that byte
+        #-- range (see splitFile()).  Record numbers then count from start.
+        #-- lazy=True hands out lazy MARC21Records; from a mapped file they
+        #-- must be decoded before the file is closed.
+        #-- filename may be '-' for stdin, and a gzip, bzip2 or xz file is
+        #-- decompressed as it is read (see BlockReader).  Those can only be
+        #-- read forwards, with no mapping, span or index; except that a
+        #-- gzip file can be indexed, and is then read through a GzipSeeker.
+        if span is not None and indexed:
+            raise ValueError("a span can't be combined with a sidecar index")
+        self.map=None
+        self.sourceFile=None
+        self.sidecar=None
+        self.sourceFile=openInput(filename)
+        self.streamed=isinstance(self.sourceFile,BlockReader)
+        if self.streamed and indexed and filename!='-' and self.sourceFile.decompressor is gzipDecompressor:
+            self.sourceFile.close()
+            self.sourceFile=None
+            self.sidecar=MARC21GzipIndex(filename)
+            self.sourceFile=GzipSeeker(filename,self.sidecar)
+            self.streamed=False
+        if self.streamed:
+            if span is not None or indexed:
+                self.sourceFile.close()
+                raise ValueError("%s can only be read straight through"%filename)
+            mapped=False
+            size=sys.maxsize
+        elif self.sidecar is not None:
+            mapped=False
+            size=self.sidecar.offsets[-1]
+        else:
+            size=os.fstat(self.sourceFile.fileno()).st_size
+        self.start,self.end=span if span is not None else (0,size)
+        self.index=array('L',[self.start])
         self.current=0
-        self.sourceFile=open(filename,'rb')
+        self.lazy=lazy
+        self.offset=self.start
+        if self.start:
+            self.sourceFile.seek(self.start)
+        #-- In mapped mode the whole file is mmapped and each record is
+        #-- parsed in place from its window in the mapping, rather than
+        #-- being read() into a fresh string first.
+        if mapped and size>0:
+            self.map=mmap.mmap(self.sourceFile.fileno(),0,access=mmap.ACCESS_READ)
+            if hasattr(self.map,'madvise'):
+                self.map.madvise(mmap.MADV_SEQUENTIAL)
+        #-- With a sidecar index, self.index holds every record offset up
+        #-- front, so seekRecord() and get() don't have to scan the file.
+        if indexed and self.sidecar is None:
+            self.sidecar=MARC21Index(filename)
+        if self.sidecar is not None:
+            self.index=self.sidecar.offsets
 
     def __del__(self):
-        self.sourceFile.close()
+        if self.map is not None:
+            self.map.close()
+        if self.sourceFile is not None:
+            self.sourceFile.close()
 
     def next(self):
+        raw=self.nextRaw()
+        if raw is None:
+            return None
+        return MARC21Record(raw[0],raw[1],self.lazy)
+
+    def nextRaw(self):
+        #-- Step over the next record without parsing it, and return it as
+        #-- (data,offset): a window into the mapping in mapped mode, or a
+        #-- string holding just the record otherwise.
+        if self.map is not None:
+            offset=self.offset
+            if offset>=self.end:
+                return None
+            recordLength=int(self.map[offset:offset+5])
+            self.offset=offset+recordLength
+            self.current=self.current+1
+            if self.current==len(self.index):
+                self.index.append(self.offset)
+            return self.map,offset
+        if self.sourceFile.tell()>=self.end:
+            return None
         data=self.sourceFile.read(5)
         if data=="":
             return None
@@ -247,14 +589,506 @@ class MARC21File:
             recordLength=int(data)
             data=data+self.sourceFile.read(recordLength-5)
             self.current=self.current+1
-            self.index.append(self.sourceFile.tell())
-            return MARC21Record(data)
+            if self.current==len(self.index):
+                self.index.append(self.sourceFile.tell())
+            return data,0
+
+    def nextBatch(self,n,where=None):
+        #-- Read up to n records, decoding their directories together
+        #-- (see parseBatch()).  Returns an empty list at the end.  With
+        #-- where (see compileFilter()), only the raw records it accepts
+        #-- are decoded and returned, so the list may be short or empty
+        #-- before the end; self.current tells how far the file was read.
+        raws=[]
+        for i in xrange(n):
+            raw=self.nextRaw()
+            if raw is None:
+                break
+            if where is None or where(raw[0],raw[1]):
+                raws.append(raw)
+        return self.parseRaws(raws)
+
+    def parseRaws(self,raws):
+        #-- Parse a list of records as returned by nextRaw() in one go.
+        if not raws:
+            return []
+        if self.map is not None:
+            return parseBatch(self.map,[offset for data,offset in raws],self.lazy)
+        offsets=[]
+        offset=0
+        for data,start in raws:
+            offsets.append(offset)
+            offset=offset+len(data)
+        return parseBatch(''.join([data for data,start in raws]),offsets,self.lazy)
+
+    def seekRecord(self,n):
+        #-- Position the file so that next() returns record n (counting
+        #-- from 0).  Without a sidecar index, records past the furthest
+        #-- one read so far are skipped over using their leader lengths.
+        if n<0:
+            n=0
+        last=len(self.index)-1
+        if n>last:
+            n=last if self.sidecar is not None else self.skip(n)
+        self.current=n
+        if self.map is not None:
+            self.offset=self.index[n]
+        else:
+            self.sourceFile.seek(self.index[n])
+        return n
+
+    def skip(self,n):
+        offset=self.index[-1]
+        self.sourceFile.seek(offset)
+        while len(self.index)-1<n and offset<self.end:
+            data=self.sourceFile.read(5)
+            if len(data)<5:
+                break
+            offset=offset+int(data)
+            self.sourceFile.seek(offset)
+            self.index.append(offset)
+        return len(self.index)-1
+
+    def tell(self):
+        #-- The byte offset just past the last record read.
+        return self.index[self.current]
+
+    def inputOffset(self):
+        #-- How far into the input file reading has got: the same as tell()
+        #-- but for a compressed file, where it counts compressed bytes.
+        if self.streamed:
+            return self.sourceFile.consumed
+        if isinstance(self.sourceFile,GzipSeeker):
+            return self.sourceFile.inputOffset()
+        return self.tell()
 
     def rewind(self, n=1):
-        self.current=self.current-n
-        if self.current<0:
-            self.current=0
-        self.sourcefile.seek(self.index[self.current])
+        self.seekRecord(self.current-n)
+
+    def records(self,start=0,count=None,batch=0,where=None):
+        #-- Iterate over count records (or to the end) starting at record
+        #-- start, reading them batch at a time with nextBatch() if given.
+        #-- where (see compileFilter()) is tried on each raw record first,
+        #-- and only those it accepts are parsed and returned; count still
+        #-- counts the records read.
+        self.seekRecord(start)
+        end=None if count is None else self.current+count
+        while end is None or self.current<end:
+            before=self.current
+            if batch:
+                records=self.nextBatch(batch if end is None else min(batch,end-before),where)
+            else:
+                raw=self.nextRaw()
+                records=[]
+                if raw is not None and (where is None or where(raw[0],raw[1])):
+                    records=[MARC21Record(raw[0],raw[1],self.lazy)]
+            if self.current==before:
+                return
+            for record in records:
+                yield record
+
+    def get(self,controlNumber):
+        #-- Fetch the record whose 001 field is controlNumber, or None.
+        if self.sidecar is None:
+            raise TypeError("get() needs an indexed MARC21File")
+        for n in self.sidecar.lookup(controlNumber):
+            self.seekRecord(n)
+            record=self.next()
+            if record is not None and '001' in record and record['001']==controlNumber:
+                return record
+        return None
+
+class MARC21Index:
+    #-- A persistent record index, stored next to the MARC21 file as
+    #-- <filename>.idx and rebuilt whenever the file's size or mtime change.
+    #-- offsets[n] is the byte offset of record n, with one extra entry for
+    #-- the end of the file.  keys holds the crc32 of each record's 001
+    #-- control number in sorted order, and recnos the matching record
+    #-- numbers, so get() is a binary search plus a check of the 001 field.
+    MAGIC='MARC21IDX1'
+    HEADER=struct.Struct('<BQQQ')
+
+    def __init__(self,filename):
+        self.filename=filename
+        self.path=filename+'.idx'
+        st=os.stat(filename)
+        self.stamp=(st.st_size,int(st.st_mtime))
+        if not self.load():
+            self.build()
+            self.save()
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def load(self):
+        try:
+            f=open(self.path,'rb')
+        except IOError:
+            return False
+        try:
+            try:
+                return self.read(f)
+            except (EOFError,struct.error):
+                return False
+        finally:
+            f.close()
+
+    def read(self,f):
+        if f.read(len(self.MAGIC))!=self.MAGIC:
+            return False
+        itemsize,size,mtime,count=MARC21Index.HEADER.unpack(f.read(MARC21Index.HEADER.size))
+        if itemsize!=array('L').itemsize or (size,mtime)!=self.stamp:
+            return False
+        self.offsets=array('L')
+        self.offsets.fromfile(f,count+1)
+        self.keys=array('L')
+        self.keys.fromfile(f,count)
+        self.recnos=array('L')
+        self.recnos.fromfile(f,count)
+        return True
+
+    def build(self):
+        #-- One pass over the file, reading only each leader and the 001
+        #-- directory entry.
+        self.offsets=array('L')
+        entries=[]
+        size=self.stamp[0]
+        f=open(self.filename,'rb')
+        try:
+            data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) if size else ''
+            offset=0
+            while offset<size:
+                n=len(self.offsets)
+                self.offsets.append(offset)
+                controlNumber=readControlField(data,offset,'001')
+                if controlNumber is not None:
+                    entries.append(((zlib.crc32(controlNumber)&0xffffffff)<<32)|n)
+                offset=offset+int(data[offset:offset+5])
+            self.offsets.append(offset)
+            if size:
+                data.close()
+        finally:
+            f.close()
+        self.sortKeys(entries)
+
+    def sortKeys(self,entries):
+        #-- entries holds crc32(001)<<32|recno for each record.
+        entries.sort()
+        self.keys=array('L',[entry>>32 for entry in entries])
+        self.recnos=array('L',[entry&0xffffffff for entry in entries])
+
+    def save(self):
+        #-- Write to a temporary file and rename it into place, so a reader
+        #-- never sees a half-written index.  An unwritable directory just
+        #-- means the index is rebuilt next time.
+        tmp=self.path+'.tmp'
+        try:
+            f=open(tmp,'wb')
+            try:
+                self.write(f)
+            finally:
+                f.close()
+            os.rename(tmp,self.path)
+        except (IOError,OSError):
+            pass
+
+    def write(self,f):
+        f.write(self.MAGIC)
+        f.write(MARC21Index.HEADER.pack(array('L').itemsize,self.stamp[0],self.stamp[1],len(self)))
+        self.offsets.tofile(f)
+        self.keys.tofile(f)
+        self.recnos.tofile(f)
+
+    def lookup(self,controlNumber):
+        #-- Candidate record numbers for controlNumber.  crc32 collisions
+        #-- are possible, so callers must check the record itself.
+        key=zlib.crc32(controlNumber)&0xffffffff
+        i=bisect.bisect_left(self.keys,key)
+        candidates=[]
+        while i<len(self.keys) and self.keys[i]==key:
+            candidates.append(self.recnos[i])
+            i=i+1
+        return candidates
+
+class MARC21GzipIndex(MARC21Index):
+    #-- The index of a gzip-compressed MARC21 file, also <filename>.idx,
+    #-- with the offsets of the uncompressed records and, on top of those,
+    #-- the gzindex checkpoints taken every few MB of compressed input (see
+    #-- gzindex.build()).  Seeking to a record then means decompressing
+    #-- from the last checkpoint before it rather than from the start of
+    #-- the file.  Each checkpoint's 32KB window is stored compressed.
+    MAGIC='MARC21GZX1'
+    CHECKPOINTS=struct.Struct('<Q')
+
+    def read(self,f):
+        if not MARC21Index.read(self,f):
+            return False
+        count,=MARC21GzipIndex.CHECKPOINTS.unpack(f.read(MARC21GzipIndex.CHECKPOINTS.size))
+        self.outs=array('L')
+        self.outs.fromfile(f,count)
+        self.ins=array('L')
+        self.ins.fromfile(f,count)
+        self.bits=array('B')
+        self.bits.fromfile(f,count)
+        self.windowOffsets=array('L')
+        self.windowOffsets.fromfile(f,count+1)
+        self.windows=f.read(self.windowOffsets[-1])
+        if len(self.windows)!=self.windowOffsets[-1]:
+            raise EOFError
+        return True
+
+    def build(self):
+        #-- One pass decompressing the file, finding the records in the
+        #-- output as it comes (see scan()).
+        self.offsets=array('L')
+        self.entries=[]
+        self.pending=''
+        self.pendingOffset=0
+        f=open(self.filename,'rb')
+        try:
+            checkpoints=gzindex.build(f,self.scan)
+        finally:
+            f.close()
+        self.offsets.append(self.pendingOffset)
+        self.sortKeys(self.entries)
+        del self.entries,self.pending
+        self.outs=array('L',[out for out,pos,bits,window in checkpoints])
+        self.ins=array('L',[pos for out,pos,bits,window in checkpoints])
+        self.bits=array('B',[bits for out,pos,bits,window in checkpoints])
+        windows=[zlib.compress(window) for out,pos,bits,window in checkpoints]
+        self.windowOffsets=array('L',[0])
+        for window in windows:
+            self.windowOffsets.append(self.windowOffsets[-1]+len(window))
+        self.windows=''.join(windows)
+
+    def scan(self,data):
+        #-- Note every whole record in the next piece of output, keeping
+        #-- a partial one at the end for the next call.
+        data=self.pending+data
+        offset=0
+        while len(data)-offset>=5:
+            recordLength=int(data[offset:offset+5])
+            if len(data)-offset<recordLength:
+                break
+            n=len(self.offsets)
+            self.offsets.append(self.pendingOffset+offset)
+            controlNumber=readControlField(data,offset,'001')
+            if controlNumber is not None:
+                self.entries.append(((zlib.crc32(controlNumber)&0xffffffff)<<32)|n)
+            offset=offset+recordLength
+        self.pending=data[offset:]
+        self.pendingOffset=self.pendingOffset+offset
+
+    def write(self,f):
+        MARC21Index.write(self,f)
+        f.write(MARC21GzipIndex.CHECKPOINTS.pack(len(self.outs)))
+        self.outs.tofile(f)
+        self.ins.tofile(f)
+        self.bits.tofile(f)
+        self.windowOffsets.tofile(f)
+        f.write(self.windows)
+
+    def find(self,offset):
+        #-- The number of the last checkpoint at or before the uncompressed
+        #-- offset, or -1 if there is none.
+        return bisect.bisect_right(self.outs,offset)-1
+
+    def checkpoint(self,i):
+        #-- Checkpoint i as (out,in,bits,window).
+        window=self.windows[self.windowOffsets[i]:self.windowOffsets[i+1]]
+        return self.outs[i],self.ins[i],self.bits[i],zlib.decompress(window)
+
+def parseBatch(data,offsets,lazy=False):
+    #-- Parse the records starting at each of offsets in data.  With NumPy,
+    #-- the directories of the whole batch are joined into one S12 array
+    #-- of entries and their lengths and offsets decoded in one go, instead
+    #-- of two int() calls per entry.  Without it, each record is parsed
+    #-- on its own; and so is a batch holding any entry that isn't plain
+    #-- digits (eg. space-padded, which int() takes) or is cut short, so
+    #-- that it is read, or fails, just as it would one record at a time.
+    if numpy is None:
+        return [MARC21Record(data,offset,lazy) for offset in offsets]
+    ends=[data.find(MARC21Record.FIELD_TERMINATOR,offset+24) for offset in offsets]
+    directories=[data[offset+24:end] for offset,end in zip(offsets,ends)]
+    for directoryData in directories:
+        if len(directoryData)%12:
+            return [MARC21Record(data,offset,lazy) for offset in offsets]
+    entries=numpy.frombuffer(''.join(directories),dtype='S12')
+    raw=entries.view(numpy.uint8).reshape(-1,12)
+    digits=raw[:,3:].astype(numpy.int32)-ord('0')
+    if ((digits<0)|(digits>9)).any():
+        return [MARC21Record(data,offset,lazy) for offset in offsets]
+    lengths=digits[:,:4].dot([1000,100,10,1]).tolist()
+    fieldOffsets=digits[:,4:].dot([10000,1000,100,10,1]).tolist()
+    tags=raw[:,:3].copy().view('S3').ravel().tolist()
+
+    records=[]
+    i=0
+    for offset,end,directoryData in zip(offsets,ends,directories):
+        record=MARC21Record(lazy=lazy)
+        record.parseLeader(data[offset:offset+24])
+        directory={}
+        for j in xrange(i,i+len(directoryData)//12):
+            tag=tags[j]
+            if directory.has_key(tag):
+                if type(directory[tag])==type([]):
+                    directory[tag].append((lengths[j],fieldOffsets[j]))
+                else:
+                    directory[tag]=[directory[tag],(lengths[j],fieldOffsets[j])]
+            else:
+                directory[tag]=(lengths[j],fieldOffsets[j])
+        i=i+len(directoryData)//12
+        record.load(data,end+1,directory)
+        records.append(record)
+    return records
+
+def splitFile(filename,n):
+    #-- Cut a MARC21 file into at most n byte ranges of about equal size,
+    #-- each starting on a record boundary.  A cut goes just after a
+    #-- RECORD_TERMINATOR, but only where the next 5 bytes are a record
+    #-- length that ends on another RECORD_TERMINATOR (or the end of the
+    #-- file), so a stray terminator byte inside field data is skipped.
+    size=os.path.getsize(filename)
+    if n<=1 or size==0:
+        return [(0,size)]
+    f=open(filename,'rb')
+    data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    try:
+        cuts=[0]
+        for i in range(1,n):
+            offset=findRecordStart(data,max(size*i//n,cuts[-1]+1),size)
+            if offset>=size:
+                break
+            cuts.append(offset)
+    finally:
+        data.close()
+        f.close()
+    cuts.append(size)
+    return zip(cuts[:-1],cuts[1:])
+
+def findRecordStart(data,offset,size):
+    #-- The first record boundary at or after offset (or size if none).
+    pos=data.find(MARC21Record.RECORD_TERMINATOR,offset-1)
+    while pos>=0:
+        start=pos+1
+        if start>=size:
+            break
+        length=data[start:start+5]
+        if length.isdigit() and 24<=int(length)<=size-start:
+            if data[start+int(length)-1]==MARC21Record.RECORD_TERMINATOR:
+                return start
+        pos=data.find(MARC21Record.RECORD_TERMINATOR,start)
+    return size
+
+def readControlField(data,offset,tag):
+    #-- Read a control field straight from the raw record at offset,
+    #-- without parsing the rest of the record.
+    FTindex=data.find(MARC21Record.FIELD_TERMINATOR,offset+24)
+    for i in xrange(offset+24,FTindex,12):
+        if data[i:i+3]==tag:
+            fieldLength=int(data[i+3:i+7])
+            fieldOffset=FTindex+1+int(data[i+7:i+12])
+            return data[fieldOffset:fieldOffset+fieldLength-1]
+    return None
+
+#-- Leader positions by name: those MARC21Record.parseLeader() sets, plus
+#-- the MARC 21 names of the single positions inside them.
+LEADER_FIELDS={
+    'record_status':(5,6),
+    'type_of_record':(6,7),
+    'implementation_defined1':(7,9),
+    'bibliographic_level':(7,8),
+    'type_of_control':(8,9),
+    'character_coding_scheme':(9,10),
+    'implementation_defined2':(17,20),
+    'encoding_level':(17,18),
+    'descriptive_cataloging_form':(18,19),
+    'multipart_resource_level':(19,20),
+}
+
+FILTER_TERM=re.compile(r'^(?:has:(?P<has>\w{3})|'
+                       r'(?:leader\.(?P<name>\w+)|(?P<tag>leader|00\d)/(?P<start>\d+)(?:-(?P<end>\d+))?)'
+                       r'(?P<op>!?=)(?P<values>.*))$',re.S)
+
+def directoryEntry(tag):
+    #-- A pattern that finds tag's first entry in a directory, stepping
+    #-- over whole 12-byte entries so a tag never matches mid-entry.
+    return re.compile(r'(?:.{12})*?'+re.escape(tag)+r'(\d{4})(\d{5})',re.S)
+
+def compileFilter(expression):
+    #-- Compile a filter expression into where(data,offset), a test of the
+    #-- raw record at offset that reads only its leader, its directory
+    #-- and any control fields named, and decodes nothing else.  Terms:
+    #--
+    #--   leader.type_of_record=e      a named leader position (LEADER_FIELDS)
+    #--   leader/06=e,f                leader positions, MARC style (06-07)
+    #--   008/35-37=eng                positions of a control field
+    #--   has:020                      the record has a 020 field
+    #--
+    #-- with = or != and any of a comma-separated list of values, joined
+    #-- by "not", then "and", then "or".  Quote values holding spaces.
+    groups=[[]]
+    negate=False
+    for token in shlex.split(expression):
+        if token=='or':
+            if not groups[-1] or negate:
+                raise ValueError("misplaced 'or' in %r"%expression)
+            groups.append([])
+        elif token=='and':
+            if not groups[-1] or negate:
+                raise ValueError("misplaced 'and' in %r"%expression)
+        elif token=='not':
+            negate=not negate
+        else:
+            groups[-1].append((negate,filterTerm(token)))
+            negate=False
+    if not groups[-1] or negate:
+        raise ValueError("incomplete filter %r"%expression)
+
+    def where(data,offset):
+        leader=data[offset:offset+24]
+        base=offset+int(leader[12:17])
+        directory=data[offset+24:base-1]
+        for group in groups:
+            for negated,test in group:
+                if test(leader,directory,data,base)==negated:
+                    break
+            else:
+                return True
+        return False
+    return where
+
+def filterTerm(term):
+    m=FILTER_TERM.match(term)
+    if m is None:
+        raise ValueError("bad filter term %r"%term)
+    if m.group('has'):
+        entry=directoryEntry(m.group('has'))
+        return lambda leader,directory,data,base: entry.match(directory) is not None
+    if m.group('name'):
+        if m.group('name') not in LEADER_FIELDS:
+            raise ValueError("unknown leader field %r"%m.group('name'))
+        start,end=LEADER_FIELDS[m.group('name')]
+    else:
+        start=int(m.group('start'))
+        end=int(m.group('end') or start)+1
+    values=m.group('values').split(',')
+    for value in values:
+        if len(value)!=end-start:
+            raise ValueError("%r should be %d characters in %r"%(value,end-start,term))
+    values=frozenset(values)
+    equal=m.group('op')=='='
+    if m.group('tag') in (None,'leader'):
+        return lambda leader,directory,data,base: (leader[start:end] in values)==equal
+    entry=directoryEntry(m.group('tag'))
+    def test(leader,directory,data,base):
+        found=entry.match(directory)
+        if found is None:
+            return not equal
+        fieldOffset=base+int(found.group(2))
+        fieldData=data[fieldOffset:fieldOffset+int(found.group(1))-1]
+        return (fieldData[start:end] in values)==equal
+    return test
 
 def isControlField(tag):
     if tag[:2]=='00':
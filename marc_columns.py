@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+## A columnar, memory-mappable output format. Each column is written to
+## its own file(s) in one directory, so a scan reads only the columns it
+## uses:
+##
+##   <col>.cat          categoricals: uint16 codes into the column's value
+##                      list in columns.json (0 means missing)
+##   <col>.int          integers: int32, with MISSING for no value
+##   <col>.off/.blob    strings: uint offsets into a blob of UTF-8 bytes;
+##                      value i is blob[off[i]:off[i+1]], and the values of
+##                      a multi-valued field are joined by LIST_SEPARATOR
+##
+## columns.json describes every column and the record count. Writing needs
+## only the standard library; open_columns() maps the files with NumPy.
+import os
+import sys
+import json
+from array import array
+
+MISSING = -2 ** 31
+LIST_SEPARATOR = chr(31)
+MANIFEST = 'columns.json'
+
+class ColumnSink:
+    """Writes records as columns into directory.
+
+    columns is the list of columns; categorical and integer name those to
+    dictionary-encode and to store as int32. derived maps extra integer
+    columns to a function computing them from the record.
+    """
+
+    # records buffered per column between writes.
+    BATCH = 65536
+
+    def __init__(self, directory, columns, categorical=(), integer=(), derived={}):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.derived = derived
+        self.count = 0
+        self.kinds = {}
+        self.files = {}
+        self.buffers = {}
+        self.values = {}
+        self.codes = {}
+        self.offsets = {}
+        for c in columns:
+            if c in categorical:
+                self.add(c, 'cat', array('H'))
+                self.values[c] = [None]
+                self.codes[c] = {}
+            elif c in integer:
+                self.add(c, 'int', array('i'))
+            else:
+                self.add(c, 'str', array('L', [0]))
+                self.offsets[c] = 0
+                self.files[c + '.blob'] = open(self.path(c + '.blob'), 'wb')
+                self.buffers[c + '.blob'] = []
+        for c in derived:
+            self.add(c, 'int', array('i'))
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def add(self, column, kind, buf):
+        self.kinds[column] = kind
+        name = column + ('.off' if kind == 'str' else '.' + kind)
+        self.files[column] = open(self.path(name), 'wb')
+        self.buffers[column] = buf
+
+    def write(self, record):
+        for c, kind in self.kinds.iteritems():
+            if c in self.derived:
+                v = self.derived[c](record)
+            else:
+                v = record.get(c)
+            if isinstance(v, list):
+                v = LIST_SEPARATOR.join(v)
+            if kind == 'cat':
+                code = self.codes[c].get(v)
+                if code is None:
+                    if v is None or v == '':
+                        code = 0
+                    else:
+                        code = self.codes[c][v] = len(self.values[c])
+                        self.values[c].append(v)
+                self.buffers[c].append(code)
+            elif kind == 'int':
+                if not isinstance(v, int) or not MISSING < v < -MISSING:
+                    v = MISSING
+                self.buffers[c].append(v)
+            else:
+                v = v.encode('utf-8') if isinstance(v, unicode) else str(v or '')
+                self.offsets[c] += len(v)
+                self.buffers[c].append(self.offsets[c])
+                self.buffers[c + '.blob'].append(v)
+        self.count += 1
+        if self.count % self.BATCH == 0:
+            self.flush()
+
+    def flush(self):
+        for name, buf in self.buffers.iteritems():
+            if isinstance(buf, list):
+                self.files[name].write(''.join(buf))
+                self.buffers[name] = []
+            else:
+                buf.tofile(self.files[name])
+                del buf[:]
+
+    def close(self):
+        self.flush()
+        for f in self.files.itervalues():
+            f.close()
+        order = '<' if sys.byteorder == 'little' else '>'
+        dtypes = {
+            'cat': order + 'u2',
+            'int': order + 'i4',
+            'str': order + 'u%d' % array('L').itemsize,
+        }
+        manifest = {'count': self.count, 'columns': {}}
+        for c, kind in self.kinds.iteritems():
+            manifest['columns'][c] = {'kind': kind, 'dtype': dtypes[kind]}
+            if kind == 'cat':
+                manifest['columns'][c]['values'] = self.values[c]
+        with open(self.path(MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+class StringColumn:
+    """A memory-mapped string column: column[i] is the i-th value (a list
+    of values for multi-valued fields), len(column) the record count."""
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        v = self.blob[self.offsets[i]:self.offsets[i + 1]].tostring()
+        return v.split(LIST_SEPARATOR) if LIST_SEPARATOR in v else v
+
+
+def open_columns(directory):
+    """Open a directory written by ColumnSink. Returns {column: data}, where
+    data is a numpy.memmap for integer columns (MISSING for no value), a
+    StringColumn for strings, and a (codes, values) pair for categoricals,
+    where values[codes[i]] is the value of record i (None if missing)."""
+    import numpy
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+    count = manifest['count']
+    def mapped(name, dtype, n):
+        if n == 0:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(os.path.join(directory, name), dtype=dtype, mode='r', shape=(n,))
+    ret = {}
+    for c, info in manifest['columns'].iteritems():
+        c = str(c)
+        if info['kind'] == 'cat':
+            ret[c] = (mapped(c + '.cat', info['dtype'], count), info['values'])
+        elif info['kind'] == 'int':
+            ret[c] = mapped(c + '.int', info['dtype'], count)
+        else:
+            offsets = mapped(c + '.off', info['dtype'], count + 1)
+            size = int(offsets[-1]) if count else 0
+            ret[c] = StringColumn(offsets, mapped(c + '.blob', 'u1', size))
+    return ret
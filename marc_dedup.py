@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+## Duplicate detection over a whole export. Each record's docid and 035a
+## system control numbers are checked against everything seen earlier in
+## the run. The seen keys live in fixed-size integer hash tables rather
+## than sets of strings, so memory stays bounded over all 12M records.
+from array import array
+
+SLOT = array('L').itemsize
+MASK = (1 << 8 * SLOT) - 1
+# Fibonacci hashing, to spread runs of consecutive docids over the table.
+SCRAMBLE = 0x9E3779B97F4A7C15 & MASK
+
+class IntSet:
+    """A set of integers in one preallocated table of memory bytes, with
+    open addressing and linear probing. Keys are reduced to table words,
+    0 being the empty slot. add() raises MemoryError once the table is
+    MAX_LOAD full, since probing gets slow beyond that."""
+
+    MAX_LOAD = 0.9
+
+    def __init__(self, memory):
+        self.size = max(memory // SLOT, 1)
+        self.table = array('L', [0]) * self.size
+        self.count = 0
+
+    def add(self, key):
+        """Adds key, and returns whether it was already in the set."""
+        key = (key & MASK) or 1
+        table = self.table
+        i = (key * SCRAMBLE & MASK) % self.size
+        while True:
+            k = table[i]
+            if k == key:
+                return True
+            if not k:
+                break
+            i += 1
+            if i == self.size:
+                i = 0
+        # always leave an empty slot, or a probe would never end.
+        if self.count + 1 >= self.size * self.MAX_LOAD:
+            raise MemoryError('duplicate table full after %d keys; '
+                              'allow it more memory' % self.count)
+        table[i] = key
+        self.count += 1
+        return False
+
+
+def key(value):
+    """Numeric ids are their own key, so the check is exact for the usual
+    docid. Other values are hashed, with a tiny chance of a false match."""
+    if value.isdigit():
+        return int(value) + 1
+    return hash(value)
+
+class Dedup:
+    """Finds records that repeat the docid or a system control number of an
+    earlier record. memory bytes are split between the two tables."""
+
+    def __init__(self, memory):
+        self.tables = {
+            'docid': IntSet(memory // 2),
+            'system_control_number': IntSet(memory // 2),
+        }
+        self.counts = dict.fromkeys(self.tables, 0)
+
+    def check(self, record):
+        """The columns in which record repeats an earlier record, if any."""
+        duplicates = []
+        for column, table in sorted(self.tables.iteritems()):
+            values = record.get(column)
+            if not values:
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            seen = False
+            for v in set(values):
+                seen = table.add(key(v)) or seen
+            if seen:
+                duplicates.append(column)
+                self.counts[column] += 1
+        return duplicates
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+## Incremental exports. A state file keeps a fingerprint of every record
+## of the last export: its 001 id and a crc32 of its converted content.
+## Run against a new release of the dump, DeltaState lets through only the
+## records that are new or changed, and then reports the ids that are gone.
+##
+## The state file holds, after MAGIC and HEADER (item count):
+##
+##   keys      uint32 crc32 of each id, sorted
+##   hashes    uint32 content hash of the record with the same position
+##   offsets   uint32 offsets into ids, one extra at the end; id i is
+##             ids[offsets[i]:offsets[i+1]]
+##   ids       the ids, concatenated in keys order
+##
+## Two ids can share a crc32, so a lookup checks the id itself.
+import os
+import struct
+import zlib
+import bisect
+from array import array
+
+MAGIC = 'MARCDELTA1'
+HEADER = struct.Struct('<Q')
+
+def crc(s):
+    return zlib.crc32(s) & 0xffffffff
+
+def fingerprint(record):
+    """A hash of everything in a converted record, independent of key order.
+    update_date (005) is part of it, so a re-cataloged record changes even
+    when nothing we export does."""
+    return crc(repr(sorted(record.iteritems())))
+
+class DeltaState:
+    """The fingerprints of the previous export, read from path if it exists,
+    and those of the current one, written back by save().
+
+    check(record) returns 'new', 'changed' or None (unchanged); once every
+    record has been checked, deleted() yields the ids not seen this time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = array('I')
+        self.hashes = array('I')
+        self.offsets = array('I', [0])
+        self.ids = ''
+        if os.path.exists(path):
+            self.load()
+        self.seen = bytearray(len(self.keys))
+        # this run's fingerprints, in the order the records come.
+        self.new_keys = array('I')
+        self.new_hashes = array('I')
+        self.new_offsets = array('I', [0])
+        self.new_ids = array('c')
+        self.counts = dict.fromkeys(['new', 'changed', 'unchanged', 'deleted'], 0)
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a delta state file' % self.path)
+            count, = HEADER.unpack(f.read(HEADER.size))
+            self.keys.fromfile(f, count)
+            self.hashes.fromfile(f, count)
+            self.offsets = array('I')
+            self.offsets.fromfile(f, count + 1)
+            self.ids = f.read(self.offsets[-1])
+
+    def find(self, key, id):
+        i = bisect.bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            if self.ids[self.offsets[i]:self.offsets[i + 1]] == id:
+                return i
+            i += 1
+        return None
+
+    def check(self, record):
+        id = record.get('id')
+        if not id:
+            # nothing to match it by next time: always export it.
+            self.counts['new'] += 1
+            return 'new'
+        key = crc(id)
+        h = fingerprint(record)
+        self.new_keys.append(key)
+        self.new_hashes.append(h)
+        self.new_ids.fromstring(id)
+        self.new_offsets.append(len(self.new_ids))
+        i = self.find(key, id)
+        if i is None:
+            change = 'new'
+        else:
+            self.seen[i] = 1
+            change = 'changed' if self.hashes[i] != h else None
+        self.counts[change or 'unchanged'] += 1
+        return change
+
+    def deleted(self):
+        for i in xrange(len(self.keys)):
+            if not self.seen[i]:
+                self.counts['deleted'] += 1
+                yield self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def save(self):
+        """Write this run's fingerprints, replacing the old state file only
+        once the new one is complete. An id seen more than once keeps its
+        last fingerprint."""
+        ids = self.new_ids.tostring()
+        offsets = self.new_offsets
+        # a stable sort keeps each key's records in run order.
+        order = []
+        group = {}
+        for n in sorted(xrange(len(self.new_keys)), key=self.new_keys.__getitem__):
+            if group and self.new_keys[n] != self.new_keys[order[-1]]:
+                order[-len(group):] = sorted(group.itervalues())
+                group = {}
+            id = ids[offsets[n]:offsets[n + 1]]
+            if id not in group:
+                order.append(n)
+            group[id] = n
+        if group:
+            order[-len(group):] = sorted(group.itervalues())
+        keys = array('I', [self.new_keys[n] for n in order])
+        hashes = array('I', [self.new_hashes[n] for n in order])
+        blob = [ids[offsets[n]:offsets[n + 1]] for n in order]
+        positions = array('I', [0])
+        for id in blob:
+            positions.append(positions[-1] + len(id))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            f.write(HEADER.pack(len(keys)))
+            keys.tofile(f)
+            hashes.tofile(f)
+            positions.tofile(f)
+            f.write(''.join(blob))
+        os.rename(tmp, self.path)
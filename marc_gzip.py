@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+## Block-compressed output (marc.py --compress). The output is cut into
+## blocks of BLOCK bytes, each compressed as a gzip member of its own on a
+## pool of threads (zlib lets go of the GIL while it compresses), and the
+## members are written in order. Together they are one valid gzip file, as
+## far as gunzip or zcat is concerned; and since no member depends on
+## another, a reader can start at any of them. The block index, written as
+## JSON next to the output, lists them:
+##
+##   {"level": 6, "block": 4194304, "blocks": [[offset, size,
+##    data_offset, data_size], ...]}
+##
+## offset and size locate each member in the compressed file, data_offset
+## and data_size its data in the uncompressed output.
+import json
+import zlib
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+BLOCK = 4 << 20
+INDEX = '.blocks.json'
+
+def compress(data, level):
+    """data as a complete gzip member."""
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+class GzipBlockWriter:
+    """A file-like object that block-compresses what is written to it onto
+    out, and writes the block index to index (a path) on close(), if given.
+    At most 2 blocks per thread are in hand at a time."""
+
+    def __init__(self, out, level=6, threads=None, index=None, block=BLOCK):
+        self.out = out
+        self.level = level
+        self.threads = threads or multiprocessing.cpu_count()
+        self.index = index
+        self.block = block
+        self.pool = ThreadPool(self.threads)
+        self.pending = collections.deque()
+        self.buffer = []
+        self.size = 0
+        self.offset = 0
+        self.data_offset = 0
+        self.blocks = []
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.block:
+            data = ''.join(self.buffer)
+            end = len(data) - len(data) % self.block
+            for i in xrange(0, end, self.block):
+                self.submit(data[i:i + self.block])
+            self.buffer = [data[end:]]
+            self.size = len(data) - end
+
+    def submit(self, data):
+        self.pending.append((len(data), self.pool.apply_async(compress, (data, self.level))))
+        while len(self.pending) > 2 * self.threads:
+            self.drain()
+
+    def drain(self):
+        """Write out the oldest block, once it is compressed."""
+        data_size, result = self.pending.popleft()
+        member = result.get()
+        self.out.write(member)
+        self.blocks.append([self.offset, len(member), self.data_offset, data_size])
+        self.offset += len(member)
+        self.data_offset += data_size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Write the last block and the index. An empty output still gets
+        one (empty) member, as gzip would write."""
+        if self.size or not self.blocks and not self.pending:
+            self.submit(''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+        while self.pending:
+            self.drain()
+        self.pool.close()
+        self.pool.join()
+        self.out.flush()
+        if self.index:
+            with open(self.index, 'w') as f:
+                json.dump({'level': self.level, 'block': self.block,
+                           'blocks': self.blocks}, f)
+
+
+def read_index(path):
+    """The blocks of path, a file written with an index, as
+    (offset, size, data_offset, data_size) tuples."""
+    with open(path + INDEX) as f:
+        return [tuple(block) for block in json.load(f)['blocks']]
+
+def read_block(f, block):
+    """The uncompressed data of one block of the open file f."""
+    offset, size, data_offset, data_size = block
+    f.seek(offset)
+    return zlib.decompress(f.read(size), 16 + zlib.MAX_WBITS)
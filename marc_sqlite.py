@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+## Writes converted records straight into a SQLite database, with an FTS5
+## full-text index, so the catalog can be searched without a database
+## server.
+import sqlite3
+import json
+
+class SQLiteSink:
+    """Loads records into table `table` of the database at path.
+
+    columns is the list of columns, types maps a column to its SQL type
+    (default text), multi_valued columns are stored as JSON arrays and the
+    rest as text, with any repeated values joined by '; '. The search
+    columns get an FTS5 index, <table>_fts, once the load is done.
+
+    With key, the records are a delta (a change column of new, changed or
+    deleted) to apply to an earlier load: the table is kept, the rows whose
+    key matches a changed or deleted record are removed, and the new and
+    changed records are inserted. An existing FTS5 index is updated for
+    just those rows.
+    """
+
+    # rows per executemany() call, and per transaction.
+    BATCH = 5000
+    TRANSACTION = 500000
+
+    # fast and unsafe while loading: a crash means starting the load over.
+    LOAD_PRAGMAS = [
+        'journal_mode = off',
+        'synchronous = off',
+        'locking_mode = exclusive',
+        'temp_store = memory',
+        'cache_size = -262144',
+    ]
+    DONE_PRAGMAS = [
+        'journal_mode = delete',
+        'synchronous = full',
+        'locking_mode = normal',
+    ]
+
+    def __init__(self, path, columns, types={}, multi_valued=(), search=(),
+                 table='harvard', key=None):
+        self.columns = list(columns)
+        self.multi_valued = set(multi_valued)
+        self.search = [c for c in search if c in self.columns]
+        self.table = table
+        self.key = key
+        self.rows = []
+        self.gone = []
+        self.pending = 0
+        self.count = 0
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.text_factory = str
+        for pragma in self.LOAD_PRAGMAS:
+            self.db.execute('pragma ' + pragma)
+        # with an index already there, it is kept up to date row by row.
+        self.indexed = False
+        if key:
+            exists = 'select 1 from sqlite_master where name = ?'
+            self.indexed = bool(self.db.execute(exists, (table + '_fts',)).fetchone())
+        else:
+            self.db.execute('drop table if exists %s_fts' % table)
+            self.db.execute('drop table if exists %s' % table)
+        self.db.execute('create table if not exists %s (%s)' % (table, ', '.join(
+            ['%s %s' % (c, types.get(c, 'text')) for c in self.columns])))
+        self.insert = 'insert into %s values (%s)' % (
+            table, ', '.join(['?'] * len(self.columns)))
+        if key:
+            # so that replacing a row doesn't mean reading the whole table.
+            self.db.execute('create index if not exists %s_%s on %s (%s)'
+                            % (table, key, table, key))
+            self.delete = 'delete from %s where %s = ?' % (table, key)
+        if self.indexed:
+            # an external-content index is told the old values it is to drop.
+            search = ', '.join(self.search)
+            self.unindex = "insert into %s_fts(%s_fts, rowid, %s) select 'delete', rowid, %s " \
+                "from %s where %s = ?" % (table, table, search, search, table, key)
+            self.reindex = 'insert into %s_fts(rowid, %s) select rowid, %s from %s ' \
+                'where rowid > ?' % (table, search, search, table)
+        self.db.execute('begin')
+
+    def value(self, column, v):
+        if v is None or v == '' or v == []:
+            return None
+        if column in self.multi_valued:
+            return json.dumps(v if isinstance(v, list) else [v], ensure_ascii=False)
+        if isinstance(v, list):
+            return '; '.join(v)
+        return v
+
+    def write(self, record):
+        if self.key:
+            change = record.get('change')
+            if change in ('changed', 'deleted'):
+                self.gone.append((self.value(self.key, record.get(self.key)),))
+            if change == 'deleted':
+                if len(self.gone) >= self.BATCH:
+                    self.flush()
+                return
+        self.rows.append(tuple([self.value(c, record.get(c)) for c in self.columns]))
+        if len(self.rows) >= self.BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.gone:
+            # before the inserts, which may bring the same keys back.
+            if self.indexed:
+                self.db.executemany(self.unindex, self.gone)
+            self.db.executemany(self.delete, self.gone)
+            self.gone = []
+        if self.indexed:
+            # new rows are numbered on from the largest rowid.
+            top = self.db.execute('select max(rowid) from %s' % self.table).fetchone()[0]
+        self.db.executemany(self.insert, self.rows)
+        if self.indexed:
+            self.db.execute(self.reindex, (top or 0,))
+        self.pending += len(self.rows)
+        self.count += len(self.rows)
+        self.rows = []
+        if self.pending >= self.TRANSACTION:
+            self.db.execute('commit')
+            self.db.execute('begin')
+            self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.db.execute('commit')
+        if self.search and not self.indexed:
+            # an external-content index over the table, filled in one pass.
+            self.db.execute(
+                "create virtual table %s_fts using fts5(%s, content='%s', content_rowid='rowid')"
+                % (self.table, ', '.join(self.search), self.table))
+            self.db.execute("insert into %s_fts(%s_fts) values('rebuild')"
+                            % (self.table, self.table))
+        for pragma in self.DONE_PRAGMAS:
+            self.db.execute('pragma ' + pragma)
+        self.db.close()
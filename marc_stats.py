@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+## Instrumentation for long conversions (marc.py --stats): cumulative time
+## and call counts for each stage, throughput, and an ETA from the input
+## bytes consumed so far. Progress goes to stderr every interval seconds
+## as one line of key=value pairs, so a log of a long run can be parsed:
+##
+##   stats event=progress pid=1234 elapsed=60.0 records=21000 ... eta=3300
+##
+## and a last event=done line is followed by a table for people.
+##
+## With --jobs, each worker process posts its running totals to a slot of
+## shared memory instead of reporting (see share() and publish()), and the
+## parent reports the totals of the whole run.
+import os
+import sys
+import time
+import threading
+import multiprocessing
+
+STAGES = ['read', 'parse', 'extract', 'parse008', 'classify', 'serialize']
+# a worker's slot: records, bytes, then seconds and calls for each stage.
+SLOT = 2 + 2 * len(STAGES)
+
+class Meter:
+    """Stage timings and progress for one process's share of a run."""
+
+    def __init__(self, interval=10.0, out=sys.stderr):
+        self.interval = interval
+        self.out = out
+        self.shared = None
+        self.slot = None
+        self.watcher = None
+        self.begin(0)
+
+    def begin(self, total):
+        """Start over, for a run over total bytes of input."""
+        self.total = total
+        self.done = 0
+        self.source = None
+        self.records = 0
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.calls = dict.fromkeys(STAGES, 0)
+        self.started = self.last = time.time()
+
+    def open(self, source):
+        """Measure progress through source, a MARC21File, from here on."""
+        self.close()
+        self.source = source
+
+    def close(self):
+        if self.source is not None:
+            self.done += self.source.inputOffset() - self.source.start
+            self.source = None
+
+    def consumed(self):
+        if self.source is None:
+            return self.done
+        return self.done + self.source.inputOffset() - self.source.start
+
+    def add(self, stage, seconds, calls=1):
+        self.seconds[stage] += seconds
+        self.calls[stage] += calls
+
+    def record(self):
+        """Count a converted record, and report if it is time to."""
+        self.records += 1
+        if self.records % 100 == 0:
+            if self.slot is not None:
+                self.post()
+                return
+            now = time.time()
+            if now - self.last >= self.interval:
+                self.last = now
+                self.report('progress', now)
+
+    def totals(self):
+        """records, bytes consumed, {stage: seconds} and {stage: calls}: this
+        process's own, plus those the workers have posted, if any."""
+        records = self.records
+        consumed = self.consumed()
+        seconds = dict(self.seconds)
+        calls = dict(self.calls)
+        if self.shared is not None and self.slot is None:
+            shared = self.shared[:]
+            for base in xrange(0, len(shared), SLOT):
+                records += int(shared[base])
+                consumed += int(shared[base + 1])
+                for i, stage in enumerate(STAGES):
+                    seconds[stage] += shared[base + 2 + i]
+                    calls[stage] += int(shared[base + 2 + len(STAGES) + i])
+        return records, consumed, seconds, calls
+
+    def report(self, event, now=None):
+        elapsed = (now or time.time()) - self.started
+        records, consumed, seconds, calls = self.totals()
+        rate = consumed / elapsed if elapsed else 0.0
+        eta = '%.0f' % ((self.total - consumed) / rate) if rate and self.total else '-'
+        items = [
+            ('event', event),
+            ('pid', os.getpid()),
+            ('elapsed', '%.1f' % elapsed),
+            ('records', records),
+            ('bytes', consumed),
+            ('total', self.total),
+            ('records_per_sec', '%.0f' % (records / elapsed if elapsed else 0)),
+            ('mb_per_sec', '%.2f' % (rate / 1048576)),
+            ('eta', eta),
+        ]
+        for stage in STAGES:
+            items.append((stage + '_sec', '%.2f' % seconds[stage]))
+            items.append((stage + '_calls', calls[stage]))
+        print >> self.out, 'stats', ' '.join(['%s=%s' % item for item in items])
+
+    def summary(self):
+        """The done line, then each stage's share of the elapsed time."""
+        self.close()
+        now = time.time()
+        self.report('done', now)
+        records, consumed, seconds, calls = self.totals()
+        elapsed = now - self.started or 1e-9
+        print >> self.out, '%-10s %10s %10s %7s %10s' % (
+            'stage', 'calls', 'seconds', 'share', 'us/call')
+        for stage in STAGES:
+            if not calls[stage]:
+                continue
+            print >> self.out, '%-10s %10d %10.2f %6.1f%% %10.1f' % (
+                stage, calls[stage], seconds[stage], 100 * seconds[stage] / elapsed,
+                1e6 * seconds[stage] / calls[stage])
+        print >> self.out, '%d records in %.1fs: %.0f records/s, %.2f MB/s' % (
+            records, elapsed, records / elapsed, consumed / elapsed / 1048576)
+
+    ## Worker processes.
+    def share(self, workers):
+        """Shared memory with a slot for each of workers to post its totals
+        to (see publish()). Pass it to the workers when they start."""
+        self.shared = multiprocessing.Array('d', workers * SLOT, lock=False)
+        return self.shared
+
+    def publish(self, shared, slot):
+        """In a worker: post the totals to slot of shared from now on, for
+        the parent to report, rather than reporting them."""
+        self.shared = shared
+        self.slot = slot
+
+    def post(self):
+        records, consumed, seconds, calls = self.totals()
+        values = [records, consumed] + [seconds[s] for s in STAGES] + [calls[s] for s in STAGES]
+        base = self.slot * SLOT
+        self.shared[base:base + SLOT] = values
+
+    def watch(self):
+        """In the parent: report the run's progress every interval seconds
+        on a thread of its own, until unwatch()."""
+        self.stopped = threading.Event()
+        def watcher():
+            while not self.stopped.wait(self.interval):
+                self.report('progress')
+        self.watcher = threading.Thread(target=watcher)
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def unwatch(self):
+        if self.watcher is not None:
+            self.stopped.set()
+            self.watcher.join()
+            self.watcher = None
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+## Tests, run from the top of the repository with
+##
+##   python -m unittest discover -s tests -t .
+##
+## The MARC21 input they need is generated by bench.py from the sample.
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = os.path.join(ROOT, 'harvard.sample.json')
+
+class TempDir:
+    """A mixin giving each test a scratch directory, self.tmp."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='marc-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+def corpus(path, count, seed=0):
+    """Write count generated records to path."""
+    import bench
+    bench.generate(path, count, seed, SAMPLE)
+    return path
+
+def run_marc(*args):
+    """Run marc.py with args, and return its stdout; stderr is dropped."""
+    cmd = [sys.executable, os.path.join(ROOT, 'marc.py')] + list(args)
+    with open(os.devnull, 'w') as devnull:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=devnull)
+        out = p.communicate()[0]
+    if p.returncode:
+        raise AssertionError('%s exited with %d' % (' '.join(cmd), p.returncode))
+    return out
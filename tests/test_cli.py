@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import gzip
+import json
+from StringIO import StringIO
+import unittest
+from tests import TempDir, corpus, run_marc
+
+class CommandLineTest(TempDir, unittest.TestCase):
+
+    def setUp(self):
+        TempDir.setUp(self)
+        self.mrc = corpus(self.path('c.mrc'), 200)
+
+    def test_options_before_inputs(self):
+        # the documented form: marc.py MODE [options] [input ...]
+        out = run_marc('json', '--mmap', '--batch', '50', self.mrc)
+        self.assertEqual(out, run_marc('json', self.mrc, '--mmap', '--batch', '50'))
+        records = [json.loads(chunk) for chunk in out.split('\n\n') if chunk.strip()]
+        self.assertEqual(len(records), 200)
+
+    def test_inputs_between_options(self):
+        other = corpus(self.path('d.mrc'), 100, seed=1)
+        out = run_marc('ndjson', '--count', '30', self.mrc, '--mmap', other)
+        self.assertEqual(len(out.splitlines()), 60)
+
+    def test_start_without_index(self):
+        # skipped through, with no .idx written next to the input.
+        out = run_marc('ndjson', '--start', '150', self.mrc)
+        self.assertEqual(out.splitlines(), run_marc('ndjson', self.mrc).splitlines()[150:])
+        self.assertFalse(os.path.exists(self.mrc + '.idx'))
+
+    def test_shards_narrow_columns(self):
+        # the shard key is read to shard by, then left out of the output.
+        prefix = self.path('out')
+        run_marc('ndjson', '--shards', '4', '--columns', 'title', '--prefix', prefix, self.mrc)
+        manifest = json.load(open(prefix + '-manifest.json'))
+        self.assertTrue(all(s['records'] for s in manifest['shards']))
+        for s in manifest['shards']:
+            for line in open(s['path']):
+                self.assertEqual(json.loads(line).keys(), ['title'])
+
+    def test_mode_with_out(self):
+        # a usage error (exit status 2), rather than read as an input file.
+        out = self.path('x.ndjson')
+        self.assertRaisesRegexp(AssertionError, 'exited with 2$',
+                                run_marc, 'json', '--out', 'ndjson:' + out, self.mrc)
+        self.assertFalse(os.path.exists(out))
+        run_marc('--out', 'ndjson:' + out, self.mrc)
+        self.assertEqual(len(open(out).readlines()), 200)
+
+    def test_keyed_output_narrow_columns(self):
+        # pgcopy keeps the docid its child tables are keyed by; the other
+        # outputs of the same run leave it out as asked.
+        pg, nd = self.path('x.pgcopy'), self.path('x.ndjson')
+        run_marc('--out', 'pgcopy:' + pg, '--out', 'ndjson:' + nd,
+                 '--columns', 'title,isbn', self.mrc)
+        rows = open(pg).read().split('copy harvard_isbn')[1].splitlines()[1:]
+        self.assertTrue(rows[0] != '\\.' and not rows[0].startswith('\\N'))
+        self.assertTrue(all('docid' not in json.loads(line) for line in open(nd)))
+
+    def test_flags_before_inputs(self):
+        # --compress and --stats take no value, so the input isn't taken for one.
+        out = run_marc('ndjson', '--stats', '--compress', self.mrc)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(out)).read(), run_marc('ndjson', self.mrc))
+
+if __name__ == '__main__':
+    unittest.main()
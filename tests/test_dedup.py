@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from tests import TempDir, corpus, run_marc
+
+class DedupTest(TempDir, unittest.TestCase):
+
+    def test_narrow_columns(self):
+        # every record twice: the same ones go, whatever the columns. (The
+        # generated records share some 035a numbers, so that's under 100.)
+        once = open(corpus(self.path('c.mrc'), 100), 'rb').read()
+        twice = self.path('twice.mrc')
+        with open(twice, 'wb') as f:
+            f.write(once + once)
+        kept = [json.loads(line) for line in
+                run_marc('ndjson', '--dedup', 'drop', twice).splitlines()]
+        self.assertTrue(0 < len(kept) <= 100)
+        out = run_marc('ndjson', '--dedup', 'drop', '--columns', 'title', twice)
+        records = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual(records, [{'title': r['title']} for r in kept])
+
+if __name__ == '__main__':
+    unittest.main()
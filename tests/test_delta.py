@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import sqlite3
+import unittest
+from marc21 import MARC21File
+from tests import TempDir, corpus, run_marc
+
+class DeltaTest(TempDir, unittest.TestCase):
+
+    def setUp(self):
+        TempDir.setUp(self)
+        self.mrc = corpus(self.path('c.mrc'), 100)
+        self.state = self.path('state')
+
+    def delta(self, *args):
+        out = run_marc('ndjson', '--state', self.state, *args)
+        return [json.loads(line) for line in out.splitlines()]
+
+    def test_narrow_columns(self):
+        # the records are matched by id even when it isn't output.
+        first = self.delta(self.mrc, '--columns', 'title')
+        self.assertEqual(len(first), 100)
+        self.assertEqual(sorted(first[0]), ['change', 'title'])
+        self.assertEqual(self.delta(self.mrc, '--columns', 'title'), [])
+        fewer = corpus(self.path('d.mrc'), 60)
+        deleted = self.delta(fewer, '--columns', 'title')
+        self.assertEqual(len(deleted), 40)
+        self.assertTrue(all(r['change'] == 'deleted' and r['id'] for r in deleted))
+
+    def test_partial_inputs(self):
+        # what --where leaves out would look deleted, so it is refused.
+        for args in (['--count', '10'], ['--start', '10'], ['--where', 'has:020']):
+            self.assertRaises(AssertionError, self.delta, self.mrc, *args)
+        self.assertFalse(os.path.exists(self.state))
+
+    def release(self):
+        # the first 60 records as they were, the next 20 changed (generated
+        # with another seed) and the last 20 gone.
+        other = corpus(self.path('other.mrc'), 100, seed=1)
+        a, b = open(self.mrc, 'rb').read(), open(other, 'rb').read()
+        ia = MARC21File(self.mrc, indexed=True).index
+        ib = MARC21File(other, indexed=True).index
+        path = self.path('release.mrc')
+        with open(path, 'wb') as f:
+            f.write(a[:ia[60]] + b[ib[60]:ib[80]])
+        return path
+
+    def test_sqlite(self):
+        # the delta leaves the database as a whole load of the release would.
+        db, fresh, release = self.path('c.db'), self.path('fresh.db'), self.release()
+        for mrc in (self.mrc, release):
+            run_marc('sqlite', '--db', db, '--state', self.state, mrc)
+        run_marc('sqlite', '--db', fresh, release)
+        columns = [c[1] for c in sqlite3.connect(fresh).execute('pragma table_info(harvard)')]
+        def rows(path):
+            return sorted(sqlite3.connect(path).execute(
+                'select %s from harvard' % ','.join(columns)).fetchall())
+        self.assertEqual(len(rows(db)), 80)
+        self.assertEqual(rows(db), rows(fresh))
+        check = "insert into harvard_fts(harvard_fts, rank) values('integrity-check', 1)"
+        sqlite3.connect(db).execute(check)
+
+    def test_xmlpipe2_killlist(self):
+        run_marc('xmlpipe2', '--state', self.state, self.mrc)
+        out = run_marc('xmlpipe2', '--state', self.state, self.release())
+        self.assertEqual(out.count('<sphinx:killlist>'), 20)
+        self.assertEqual(out.count('<sphinx:document'), out.count('<change>changed</change>'))
+
+if __name__ == '__main__':
+    unittest.main()
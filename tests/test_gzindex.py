@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import gzip
+import unittest
+import gzindex
+from marc21 import MARC21File
+from tests import TempDir, corpus
+
+class GzipIndexTest(TempDir, unittest.TestCase):
+
+    def setUp(self):
+        TempDir.setUp(self)
+        self.plain = corpus(self.path('c.mrc'), 2000)
+        data = open(self.plain, 'rb').read()
+        offsets = MARC21File(self.plain, indexed=True).index
+        # three gzip members (as from pigz, or cat a.gz b.gz): one ends
+        # between records, the other in the middle of one.
+        self.gz = self.path('c.mrc.gz')
+        cuts = [0, offsets[700], offsets[1400] + 100, len(data)]
+        for a, b in zip(cuts, cuts[1:]):
+            member = gzip.open(self.gz, 'ab')
+            member.write(data[a:b])
+            member.close()
+        # checkpoints every 32KB of input rather than 4MB, so there are
+        # plenty in a small file.
+        self.spacing = gzindex.SPACING
+        gzindex.SPACING = 1 << 15
+
+    def tearDown(self):
+        gzindex.SPACING = self.spacing
+        TempDir.tearDown(self)
+
+    def check(self, gz):
+        plain = MARC21File(self.plain, indexed=True)
+        self.assertEqual(list(gz.index), list(plain.index))
+        self.assertTrue(len(gz.sidecar.outs) > 5)
+        wanted = range(0, 2000, 37) + [1999, 1400, 1399, 701, 700, 699, 0]
+        for n in wanted + wanted[::-1]:
+            plain.seekRecord(n)
+            gz.seekRecord(n)
+            self.assertEqual(str(gz.next()), str(plain.next()), 'record %d' % n)
+        for n in (0, 700, 1400, 1999):
+            plain.seekRecord(n)
+            number = plain.next()['001']
+            self.assertEqual(str(gz.get(number)), str(plain.get(number)))
+
+    def test_seek(self):
+        # built on the first open, then read back from the .idx file.
+        self.check(MARC21File(self.gz, indexed=True))
+        self.check(MARC21File(self.gz, indexed=True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import unittest
+from marc21 import MARC21File, MARC21Record, parseBatch
+from tests import TempDir, corpus
+
+class ParseBatchTest(TempDir, unittest.TestCase):
+
+    def setUp(self):
+        TempDir.setUp(self)
+        path = corpus(self.path('c.mrc'), 20)
+        self.data = open(path, 'rb').read()
+        self.offsets = list(MARC21File(path, indexed=True).index)[:-1]
+
+    def check(self, data):
+        batch = parseBatch(data, self.offsets)
+        single = [MARC21Record(data, offset) for offset in self.offsets]
+        self.assertEqual([str(m) for m in batch], [str(m) for m in single])
+
+    def test_batch(self):
+        self.check(self.data)
+
+    def test_space_padded_entry(self):
+        # int() reads ' 012' as 12, and so must the batch path.
+        i = self.offsets[3] + 24 + 3
+        self.assertEqual(self.data[i], '0')
+        self.check(self.data[:i] + ' ' + self.data[i + 1:])
+
+if __name__ == '__main__':
+    unittest.main()